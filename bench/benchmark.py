@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+# ----------------------------------------------------------------
+# Schuberg Philis 2012
+# ----------------------------------------------------------------
+# Description:
+#
+# Benchmark check_nexenta.py against a local mock NMS (mock_nms.py)
+# and SNMP stand-in (fake_netsnmp.py). Times -D, -T, -P and -E for
+# a range of folder counts and reports wall time, API calls, bytes
+# received, SNMP PDUs and peak memory. Results can be saved and
+# compared with a previous run to spot regressions. The startup time
+# of the plugin is measured by running it from the command line.
+# ----------------------------------------------------------------
+
+import getopt
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCH_DIR)
+
+CONFIG = """[localhost]
+api_port = %(port)s
+api_user = bench
+api_pass = bench
+snmp_community = public
+snmp_extend = ON
+check_timeout = 3600
+space_threshold = DEFAULT;80%%;90%%;100G;150G
+
+[known_errors]
+default = DEFAULT;see the runbook
+device has errors = WARNING;Disk errors found
+appliance rebooted at = CRITICAL;
+"""
+
+
+# Return a free local TCP port.
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# Call the bench object of the mock NMS to read or reset its counters.
+def mock_stats(port, meth):
+    data = json.dumps({'object': 'bench', 'method': meth, 'params': []})
+    return json.loads(urllib2.urlopen('http://127.0.0.1:%s/rest/nms/' % port, data).read())['result']
+
+
+def start_mock(port, folders, triggers, faults, latency):
+    mock = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'mock_nms.py'), '--port', str(port),
+                             '--folders', str(folders), '--triggers', str(triggers),
+                             '--faults', str(faults), '--latency', str(latency)])
+    for attempt in range(100):
+        try:
+            mock_stats(port, 'stats')
+            return mock
+        except (urllib2.URLError, socket.error):
+            time.sleep(0.1)
+    mock.kill()
+    raise RuntimeError("mock NMS did not start")
+
+
+# Run a single check in this process and print the result as JSON. Every case runs in its
+# own process, so the peak memory is that of the case.
+def run_case(check, config, snmp_latency):
+    sys.path.insert(0, PLUGIN_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    import check_nexenta
+    import fake_netsnmp
+
+    fake_netsnmp.configure(latency=snmp_latency)
+    sys.modules['netsnmp'] = fake_netsnmp
+
+    cfg = check_nexenta.ReadConfig()
+    cfg.open_config(config)
+    host = check_nexenta.resolve('localhost')
+
+    start = time.time()
+    state, output = check_nexenta.run_checks(host, ['-%s' % check], {})
+    wall = time.time() - start
+
+    print json.dumps({'wall': wall, 'state': state, 'snmp_pdus': fake_netsnmp.PDUS[0],
+                      'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+# Run a check in a child process and return its result, with the API counters of the mock.
+def bench_check(check, config, port, snmp_latency, repeat):
+    best = None
+    for attempt in range(repeat):
+        mock_stats(port, 'reset')
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--case', check,
+                                  '--config', config, '--snmp-latency', str(snmp_latency)],
+                                 stdout=subprocess.PIPE)
+        out = child.communicate()[0]
+        if child.returncode:
+            raise RuntimeError("benchmark case %s failed" % check)
+        result = json.loads(out.strip().split('\n')[-1])
+        stats = mock_stats(port, 'stats')
+        result['api_calls'] = stats['calls']
+        result['api_bytes'] = stats['bytes']
+        if not best or result['wall'] < best['wall']:
+            best = result
+    return best
+
+
+# Run the plugin from the command line and return the median wall time in milliseconds.
+# The first run is not counted, it fills the config cache.
+def bench_command(args, runs):
+    command = [sys.executable, os.path.join(PLUGIN_DIR, 'check_nexenta.py')] + args
+    times = []
+    for attempt in range(runs + 1):
+        start = time.time()
+        subprocess.Popen(command, stdout=subprocess.PIPE).communicate()
+        times.append((time.time() - start) * 1000)
+    times = times[1:]
+    times.sort()
+    return times[len(times) // 2]
+
+
+# Return the wall time of the plugin started from the command line, for -V and for every
+# check against a mock NMS with 10 folders. The real net-snmp bindings are used if installed.
+def bench_startup(checks, latency, runs):
+    port = free_port()
+    fd, config = tempfile.mkstemp(suffix='.cfg')
+    os.write(fd, CONFIG % {'port': port})
+    os.close(fd)
+
+    mock = start_mock(port, 10, 20, 2, latency)
+    try:
+        startup = {'V': bench_command(['-V'], runs)}
+        for check in checks:
+            startup[check] = bench_command(['-f', config, '-H', 'localhost', '-%s' % check], runs)
+    finally:
+        mock.kill()
+        mock.wait()
+        os.remove(config)
+    return startup
+
+
+# Return the plugin version and git revision, if known.
+def plugin_version():
+    version = subprocess.Popen([sys.executable, os.path.join(PLUGIN_DIR, 'check_nexenta.py'), '-V'],
+                               stdout=subprocess.PIPE).communicate()[0].strip()
+    try:
+        revision = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], cwd=PLUGIN_DIR,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        revision = ''
+    return "%s %s" % (version, revision)
+
+
+def print_results(results, startup, previous):
+    old = {}
+    old_startup = {}
+    if previous:
+        for result in previous['results']:
+            old[(result['check'], result['folders'])] = result
+        old_startup = previous.get('startup') or {}
+
+    print "%-5s %7s %9s %9s %11s %9s %9s" % ("check", "folders", "wall(s)", "api", "api bytes",
+                                             "snmp", "peak(KB)")
+    for result in results:
+        line = "%-5s %7s %9.3f %9s %11s %9s %9s" % ("-%s" % result['check'], result['folders'], result['wall'],
+                                                    result['api_calls'], result['api_bytes'],
+                                                    result['snmp_pdus'], result['peak_kb'])
+        before = old.get((result['check'], result['folders']))
+        if before and before['wall']:
+            line += "  (%+.0f%% wall, %+d api)" % ((result['wall'] / before['wall'] - 1) * 100,
+                                                   result['api_calls'] - before['api_calls'])
+        print line
+
+    if startup:
+        print
+        print "%-5s %9s" % ("cli", "wall(ms)")
+        for check in ['V'] + sorted([check for check in startup if check != 'V']):
+            line = "%-5s %9.1f" % ("-%s" % check, startup[check])
+            if old_startup.get(check):
+                line += "  (%+.0f%% wall)" % ((startup[check] / old_startup[check] - 1) * 100)
+            print line
+
+
+def print_usage():
+    print "usage: benchmark.py [options]"
+    print "--folders list   : Folder counts to benchmark. Defaults to 10,100,1000,10000."
+    print "--checks list    : Checks to benchmark. Defaults to D,T,P,E."
+    print "--triggers n     : Number of triggers. Defaults to 20."
+    print "--faults n       : Number of triggers reporting a fault. Defaults to 2."
+    print "--latency s      : Latency of every API call in seconds. Defaults to 0.002."
+    print "--snmp-latency s : Latency of every SNMP PDU in seconds. Defaults to 0.002."
+    print "--repeat n       : Run every case n times and report the fastest. Defaults to 1."
+    print "--startup n      : Run the plugin from the command line n times for -V and every"
+    print "                   check, and report the median wall time. Defaults to 10, 0 skips."
+    print "--save file      : Save the results as JSON."
+    print "--compare file   : Compare with results saved earlier."
+    sys.exit()
+
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "h", ["folders=", "checks=", "triggers=", "faults=", "latency=",
+                                           "snmp-latency=", "repeat=", "startup=", "save=", "compare=", "case=",
+                                           "config=", "help"])
+    folder_counts = [10, 100, 1000, 10000]
+    checks = ['D', 'T', 'P', 'E']
+    triggers, faults, latency, snmp_latency, repeat, startup_runs = 20, 2, 0.002, 0.002, 1, 10
+    save = compare = case = config = None
+    for opt, arg in opts:
+        if opt == "--folders":
+            folder_counts = [int(count) for count in arg.split(',')]
+        elif opt == "--checks":
+            checks = [check.strip('-').upper() for check in arg.split(',')]
+        elif opt == "--triggers":
+            triggers = int(arg)
+        elif opt == "--faults":
+            faults = int(arg)
+        elif opt == "--latency":
+            latency = float(arg)
+        elif opt == "--snmp-latency":
+            snmp_latency = float(arg)
+        elif opt == "--repeat":
+            repeat = int(arg)
+        elif opt == "--startup":
+            startup_runs = int(arg)
+        elif opt == "--save":
+            save = arg
+        elif opt == "--compare":
+            compare = arg
+        elif opt == "--case":
+            case = arg
+        elif opt == "--config":
+            config = arg
+        elif opt in ("-h", "--help"):
+            print_usage()
+
+    if case:
+        run_case(case, config, snmp_latency)
+        return
+
+    previous = None
+    if compare:
+        previous = json.load(open(compare))
+        print "Comparing with %s (%s)" % (compare, previous['version'])
+
+    # Keep the files the plugin keeps between runs, like the config cache, apart from those of
+    # a real installation.
+    statedir = tempfile.mkdtemp(prefix='check_nexenta_bench')
+    os.environ['TMPDIR'] = statedir
+
+    results = []
+    for folders in folder_counts:
+        port = free_port()
+        fd, config = tempfile.mkstemp(suffix='.cfg')
+        os.write(fd, CONFIG % {'port': port})
+        os.close(fd)
+
+        mock = start_mock(port, folders, triggers, faults, latency)
+        try:
+            for check in checks:
+                result = bench_check(check, config, port, snmp_latency, repeat)
+                result['check'] = check
+                result['folders'] = folders
+                results.append(result)
+        finally:
+            mock.kill()
+            mock.wait()
+            os.remove(config)
+
+    startup = None
+    if startup_runs:
+        startup = bench_startup(checks, latency, startup_runs)
+    shutil.rmtree(statedir)
+
+    print_results(results, startup, previous)
+
+    if save:
+        output = open(save, 'w')
+        json.dump({'version': plugin_version(), 'time': time.time(), 'latency': latency,
+                   'snmp_latency': snmp_latency, 'results': results, 'startup': startup}, output, indent=1)
+        output.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,190 @@
+# ----------------------------------------------------------------
+# Schuberg Philis 2012
+# ----------------------------------------------------------------
+# Description:
+#
+# Stand-in for the net-snmp python bindings, used by benchmark.py.
+# Serves uptime, CPU, interface and extend data from memory and counts
+# the PDUs the plugin would have sent, and the SNMPv3 engine discoveries. Sizes are set with configure().
+# Traffic counters grow with time, index * 1 Mbit/s in and twice that
+# out, so the plugin can compute rates between runs. Reading the output
+# of an extend takes extend_time seconds, like snmpd running its script.
+# ----------------------------------------------------------------
+
+import time
+
+MIB = []
+PDUS = [0]
+DISCOVERIES = [0]
+ENGINE_ID = '\x80\x00\x1f\x88\x80\x5c\x2a\x11\x07\x4e\x2b\x43\x51'
+LATENCY = [0.0]
+EXTEND_TIME = [0.0]
+# Booted at the start of yesterday, the same for every run of the plugin.
+BOOT = [int(time.time() / 86400) * 86400 - 86400]
+
+
+# Return a counter of octets growing by rate octets per second since boot.
+def counter(rate):
+    return lambda: str(int((time.time() - BOOT[0]) * rate))
+
+
+# Return the value of a MIB entry, counters are computed when read.
+def value(val):
+    if callable(val):
+        return val()
+    return val
+
+
+# Build the MIB tree in walk order.
+def configure(cpus=8, interfaces=16, extends=4, latency=0.0, extend_time=0.0):
+    del MIB[:]
+    LATENCY[0] = latency
+    EXTEND_TIME[0] = extend_time
+    MIB.append(('hrSystemUptime', '0', counter(100)))
+    MIB.append(('hrSystemDate', '0', '2012-10-8,10:0:0.0'))
+    for index in range(cpus):
+        MIB.append(('hrProcessorLoad', str(768 + index), str(index % 100)))
+    for index in range(1, interfaces + 1):
+        MIB.append(('ifName', str(index), 'ixgbe%s' % index))
+    for index in range(1, interfaces + 1):
+        MIB.append(('ifHCInOctets', str(index), counter(index * 125000)))
+    for index in range(1, interfaces + 1):
+        MIB.append(('ifHCOutOctets', str(index), counter(index * 250000)))
+    for index in range(extends):
+        MIB.append(('nsExtendCommand', '"extend%s"' % index, '/opt/bench/extend%s.sh' % index))
+    for column, val in (('nsExtendArgs', ''), ('nsExtendInput', ''), ('nsExtendCacheTime', '5'),
+                        ('nsExtendExecType', '1'), ('nsExtendRunType', '1'), ('nsExtendStorage', '4'),
+                        ('nsExtendStatus', '1')):
+        for index in range(extends):
+            MIB.append((column, '"extend%s"' % index, val))
+    for index in range(extends):
+        MIB.append(('nsExtendOutputFull', '"extend%s"' % index,
+                    "PERFDATA:'extend%s'=%s%%\nOUTPUT:OK: extend%s" % (index, index, index)))
+    for index in range(extends):
+        MIB.append(('nsExtendOutLine', '"extend%s".1' % index, "PERFDATA:'extend%s'=%s%%" % (index, index)))
+        MIB.append(('nsExtendOutLine', '"extend%s".2' % index, "OUTPUT:OK: extend%s" % index))
+    MIB.append(('snmpEngineID', '0', ENGINE_ID))
+    MIB.append(('snmpEngineBoots', '0', '7'))
+    MIB.append(('snmpEngineTime', '0', counter(1)))
+
+configure()
+
+
+def reset():
+    PDUS[0] = 0
+    DISCOVERIES[0] = 0
+
+
+def pdu():
+    PDUS[0] += 1
+    if LATENCY[0]:
+        time.sleep(LATENCY[0])
+
+
+# Run the scripts of the extends whose output is read, once per request.
+def run_extends(varbinds):
+    scripts = {}
+    for varbind in varbinds:
+        if varbind.tag in ('nsExtendOutputFull', 'nsExtendOutLine') and varbind.iid:
+            scripts[varbind.iid.split('"')[1]] = True
+    if EXTEND_TIME[0]:
+        time.sleep(EXTEND_TIME[0] * len(scripts))
+
+
+class Varbind:
+    def __init__(self, tag=None, iid=None, val=None, type=None):
+        if tag:
+            tag = tag.split('::')[-1]
+            if iid is None and '.' in tag:
+                tag, iid = tag.split('.', 1)
+        self.tag = tag
+        self.iid = iid
+        self.val = val
+        self.type = type
+
+
+class VarList:
+    def __init__(self, *varbinds):
+        self.varbinds = list(varbinds)
+
+    def append(self, varbind):
+        self.varbinds.append(varbind)
+
+    def __len__(self):
+        return len(self.varbinds)
+
+    def __getitem__(self, index):
+        return self.varbinds[index]
+
+    def __iter__(self):
+        return iter(self.varbinds)
+
+
+# Return the position in the MIB of the first entry after tag.iid.
+def next_position(tag, iid):
+    first = None
+    for position in range(len(MIB)):
+        if MIB[position][0] == tag:
+            if iid is None:
+                return position
+            if first is None:
+                first = position
+            if MIB[position][1] == iid:
+                return position + 1
+    if first is None:
+        return len(MIB)
+    return first
+
+
+class Session:
+    # A SNMPv3 session without a known engine discovers it with a request of its own. A
+    # session given another engine ID gets no answers.
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.rejected = kwargs.get('SecEngineId') not in (None, ENGINE_ID.encode('hex'))
+        if kwargs.get('Version') == 3 and not kwargs.get('SecEngineId'):
+            DISCOVERIES[0] += 1
+            pdu()
+
+    def get(self, varlist):
+        pdu()
+        if self.rejected:
+            return ()
+        for varbind in varlist:
+            for tag, iid, val in MIB:
+                if tag == varbind.tag and iid == varbind.iid:
+                    varbind.val = value(val)
+        run_extends(varlist)
+        return tuple([varbind.val for varbind in varlist])
+
+    # Walk with GETNEXT, one PDU per value.
+    def walk(self, varlist):
+        if self.rejected:
+            pdu()
+            return ()
+        found = []
+        for tag, iid, val in MIB:
+            if tag == varlist[0].tag:
+                pdu()
+                found.append(Varbind(tag, iid, value(val)))
+        pdu()
+        run_extends(found)
+        varlist.varbinds = found
+        return tuple([varbind.val for varbind in found])
+
+    def getbulk(self, nonrepeaters, maxrepetitions, varlist):
+        pdu()
+        if self.rejected:
+            return ()
+        positions = [next_position(varbind.tag, varbind.iid) for varbind in varlist]
+        found = []
+        for repetition in range(maxrepetitions):
+            for position in positions:
+                if position + repetition < len(MIB):
+                    tag, iid, val = MIB[position + repetition]
+                    found.append(Varbind(tag, iid, value(val)))
+                else:
+                    found.append(Varbind('.', '0', None, 'ENDOFMIBVIEW'))
+        run_extends(found)
+        varlist.varbinds = found
+        return tuple([varbind.val for varbind in found])
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+# ----------------------------------------------------------------
+# Schuberg Philis 2012
+# ----------------------------------------------------------------
+# Description:
+#
+# Local stand-in for the NMS JSON-RPC API, used by benchmark.py.
+# Emulates the folder, trigger, reporter and appliance methods used
+# by check_nexenta.py with a configurable number of folders and
+# faults, and an injectable latency per call. Triggers have a status
+# property with their state and fault count, like NMS runners.
+# ----------------------------------------------------------------
+
+import BaseHTTPServer
+import SocketServer
+import getopt
+import re
+import socket
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+# A full set of ZFS properties, like NMS returns for get_child_props with an empty pattern.
+FOLDER_PROPS = {
+    'aclinherit': 'restricted', 'aclmode': 'discard', 'atime': 'on', 'available': '90G',
+    'canmount': 'on', 'casesensitivity': 'mixed', 'checksum': 'on', 'compression': 'on',
+    'compressratio': '1.50x', 'copies': '1', 'creation': 'Mon Oct  8 10:00 2012',
+    'dedup': 'off', 'devices': 'on', 'exec': 'on', 'guid': '1234567890123456789',
+    'logbias': 'latency', 'mlslabel': 'none', 'mounted': 'yes', 'nbmand': 'off',
+    'normalization': 'none', 'primarycache': 'all', 'quota': 'none', 'readonly': 'off',
+    'recordsize': '128K', 'refcompressratio': '1.50x', 'referenced': '9G',
+    'refquota': 'none', 'refreservation': 'none', 'reservation': 'none',
+    'secondarycache': 'all', 'setuid': 'on', 'sharenfs': 'off', 'sharesmb': 'off',
+    'snapdir': 'hidden', 'sync': 'standard', 'type': 'filesystem', 'used': '10G',
+    'usedbychildren': '0', 'usedbydataset': '9G', 'usedbyrefreservation': '0',
+    'usedbysnapshots': '1G', 'utf8only': 'off', 'version': '5', 'vscan': 'off',
+    'written': '1G', 'xattr': 'on', 'zoned': 'off', 'nms:description': 'benchmark folder',
+}
+
+
+class MockNms:
+    def __init__(self, folders, triggers, faults, latency):
+        self.folders = ['pool0/folder%05d' % index for index in range(folders)]
+        self.triggers = ['nms-trigger%03d' % index for index in range(triggers)]
+        self.faults = faults
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.bytes = 0
+        self.methods = {}
+
+    def count(self, method, size):
+        self.lock.acquire()
+        try:
+            self.calls += 1
+            self.bytes += size
+            self.methods[method] = self.methods.get(method, 0) + 1
+        finally:
+            self.lock.release()
+
+    def status(self, trigger):
+        faults = int(self.triggers.index(trigger) < self.faults)
+        return 'state: ready; faults: %s; time started: %s' % (faults, time.strftime('%H:%M:%S'))
+
+    # Return the result of a call, params are handled like NMS does.
+    def call(self, obj, meth, par):
+        method = '%s.%s' % (obj, meth)
+        if method == 'folder.get_names':
+            return [name for name in self.folders if re.search(par[0], name)]
+        elif method == 'folder.get_child_props':
+            return dict([(prop, value) for prop, value in FOLDER_PROPS.items() if re.search(par[1], prop)])
+        elif method == 'reporter.get_names_by_prop':
+            if par[0] == 'status':
+                return [name for name in self.triggers if re.search(par[1], self.status(name))]
+            return self.triggers
+        elif method == 'reporter.get_child_props':
+            return dict([(prop, value) for prop, value in [('status', self.status(par[0]))] if re.search(par[1], prop)])
+        elif method == 'trigger.get_faults':
+            faults = {}
+            if self.triggers.index(par[0]) < self.faults:
+                faults['fault-%s' % par[0]] = {'description': 'Device has errors on c0t%sd0' % par[0][-3:],
+                                               'severity': 'WARNING'}
+            return faults
+        elif method == 'appliance.get_memstat':
+            return {'ram_total': 65536, 'ram_free': 16384, 'ram_paging': 0}
+        elif method == 'appliance.get_host_id':
+            return '8f3a21c7'
+        raise KeyError(method)
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 65536
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        nms = self.server.nms
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+        # The bench object is used by benchmark.py to read and reset the counters.
+        if request['object'] == 'bench':
+            if request['method'] == 'reset':
+                nms.reset()
+            response = {'result': {'calls': nms.calls, 'bytes': nms.bytes, 'methods': nms.methods},
+                        'error': None}
+        else:
+            time.sleep(nms.latency)
+            try:
+                response = {'result': nms.call(request['object'], request['method'], request['params']),
+                            'error': None}
+            except KeyError:
+                response = {'result': None, 'error': {'message': 'Unknown method %s.%s' % (
+                            request['object'], request['method'])}}
+
+        body = json.dumps(response)
+        if request['object'] != 'bench':
+            nms.count('%s.%s' % (request['object'], request['method']), len(body))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(argv):
+    port, folders, triggers, faults, latency = 8765, 100, 20, 0, 0.0
+    opts, args = getopt.getopt(argv, "", ["port=", "folders=", "triggers=", "faults=", "latency="])
+    for opt, arg in opts:
+        if opt == "--port":
+            port = int(arg)
+        elif opt == "--folders":
+            folders = int(arg)
+        elif opt == "--triggers":
+            triggers = int(arg)
+        elif opt == "--faults":
+            faults = int(arg)
+        elif opt == "--latency":
+            latency = float(arg)
+
+    server = MockServer(('127.0.0.1', port), MockHandler)
+    server.nms = MockNms(folders, triggers, faults, latency)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -48,143 +48,1251 @@
 # the health of Nexenta clusters and nodes.
 # ----------------------------------------------------------------
 
-import ConfigParser
-import base64
+import fcntl
+import fnmatch
 import getopt
 import os
+import re
 import sys
-import urllib2
-import socket
+import threading
 import time
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
-
-try:
-    import netsnmp
-except ImportError:
-    pass
+# Heavier modules like httplib, json, netsnmp and ConfigParser are imported where they
+# are used, so a run only loads what its checks need.
 
 
+# Errors are raised up to the main thread, which prints the message and exits with
+# the matching state. Worker threads can not exit the plugin themselves.
 class CritError(Exception):
-    def __init__(self, message):
-        print "CRITICAL: %s" % message
-        sys.exit(NagiosStates.CRITICAL)
+    state = 2
+    label = "CRITICAL"
+
+
+class UnknownError(Exception):
+    state = 3
+    label = "UNKNOWN"
+
+
+# Return the json module, or simplejson on Pythons without json.
+def import_json():
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+    return json
 
 
+# Every run gets its own NagiosStates instance, so runs for several Nexentas do not share RC.
+# The stages of a run set RC from their own threads, so RC is changed under a lock.
 class NagiosStates:
     RC = 0
     OK = 0
     WARNING = 1
     CRITICAL = 2
     UNKNOWN = 3
+    lock = threading.Lock()
 
     # Only change RC if greater than previous value, with exceptions for state UNKNOWN.
     def __setattr__(self, name, value):
         if (name == "RC"):
-            if (value != NagiosStates.UNKNOWN) and (NagiosStates.RC < value or NagiosStates.RC == NagiosStates.UNKNOWN):
-                NagiosStates.__dict__[name] = value
-            elif (value == NagiosStates.UNKNOWN) and (NagiosStates.RC == NagiosStates.OK):
-                NagiosStates.__dict__[name] = value
+            NagiosStates.lock.acquire()
+            try:
+                if (value != NagiosStates.UNKNOWN) and (self.RC < value or self.RC == NagiosStates.UNKNOWN):
+                    self.__dict__[name] = value
+                elif (value == NagiosStates.UNKNOWN) and (self.RC == NagiosStates.OK):
+                    self.__dict__[name] = value
+            finally:
+                NagiosStates.lock.release()
 
 
 class ReadConfig:
     # Check configfile for path, append script path if no path was given.
-    # Default to <scriptname>.cfg if no configfile was given.
+    # Default to <scriptname>.cfg if no configfile was given. The parsed config, with the
+    # space thresholds and known errors compiled, is cached until the config file or this
+    # script changes, so most runs do not need ConfigParser at all.
     def open_config(self, configfile):
         if not configfile:
             configfile = os.path.splitext(os.path.abspath(__file__))[0] + ".cfg"
         elif not os.path.dirname(configfile):
             configfile = os.path.join(os.path.dirname(__file__), configfile)
 
-        ReadConfig.parse = ConfigParser.ConfigParser()
         try:
-            ReadConfig.parse.readfp(open(configfile))
+            stat = os.stat(configfile)
+        except OSError:
+            raise CritError("Can not open configuration file: %s" % configfile)
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        key = (os.path.abspath(configfile), stat.st_mtime, stat.st_size, script, os.path.getmtime(script), __name__)
+        cachefile = os.path.join(default_state_dir(), 'config%s.cache' % key[0].replace(os.sep, '-'))
+
+        config = self.load_cache(cachefile, key)
+        if not config:
+            config = self.parse_config(configfile)
+            self.save_cache(cachefile, key, config)
+        ReadConfig.sections, ReadConfig.compiled = config
+        ReadConfig.configfile = os.path.abspath(configfile)
+        ReadConfig.key = key
+        ReadConfig.options = {}
+        for section, options in ReadConfig.sections:
+            ReadConfig.options[section] = dict(options)
+
+    # Parse the config file and compile the space thresholds of all Nexentas and the known
+    # errors. Config errors are kept and only raised when the setting is used, like before.
+    def parse_config(self, configfile):
+        import ConfigParser
+        parse = ConfigParser.ConfigParser()
+        try:
+            parse.readfp(open(configfile))
         except IOError:
             raise CritError("Can not open configuration file: %s" % configfile)
 
+        sections = []
+        for section in parse.sections():
+            options = []
+            for option in parse.options(section):
+                try:
+                    options.append((option, parse.get(section, option)))
+                except ConfigParser.Error:
+                    raise CritError("Error in config file at [%s]:%s" % (section, option))
+            sections.append((section, options))
+
+        compiled = {}
+        for section, options in sections:
+            if section in ('daemon', 'known_errors'):
+                continue
+            for option, parser in (('space_threshold', SpaceThresholds), ('traffic_threshold', TrafficThresholds),
+                                   ('forecast_threshold', ForecastThresholds)):
+                thresholds = dict(options).get(option)
+                if thresholds:
+                    try:
+                        thresholds = parser(section, thresholds)
+                    except CritError, error:
+                        thresholds = error
+                compiled[(option, section)] = thresholds
+
+        entries = []
+        default = None
+        for known, value in dict(sections).get('known_errors', []):
+            if known == "default":
+                default = value
+            else:
+                entries.append((known, value))
+        compiled['known_errors'] = KnownErrors(entries, default)
+        return sections, compiled
+
+    # Return the cached config if it was saved for the same key. The key is read first, so a
+    # config pickled by this file as a script is not read by this file as a module. The
+    # cache is only trusted if no other user could have written it, as unpickling can run code.
+    def load_cache(self, cachefile, key):
+        try:
+            cache = open(cachefile, 'rb')
+        except IOError:
+            return None
+        try:
+            stat = os.fstat(cache.fileno())
+            if stat.st_uid != os.getuid() or stat.st_mode & 022:
+                return None
+            import cPickle
+            try:
+                unpickler = cPickle.Unpickler(cache)
+                if unpickler.load() != key:
+                    return None
+                return unpickler.load()
+            except Exception:
+                return None
+        finally:
+            cache.close()
+
+    # Save the parsed config, a failure only means the next run parses the file again.
+    def save_cache(self, cachefile, key, config):
+        import cPickle
+        try:
+            write_file(cachefile, cPickle.dumps(key, 2) + cPickle.dumps(config, 2))
+        except (OSError, IOError, cPickle.PicklingError):
+            pass
+
     # Get values from the config file.
     def get_option(self, section, option):
         try:
-            return ReadConfig.parse.get(section, option)
-        except ConfigParser.NoOptionError:
-            return None
-        except ConfigParser.NoSectionError:
+            return ReadConfig.options[section].get(option)
+        except KeyError:
             raise CritError("%s not defined in config file!" % section)
 
-    # For 'known errors' we want to return the result if a option matches part of a string, or None.
-    def known_errors(self, message):
-        for known in self.parse.options('known_errors'):
-            if known in message.lower():
-                return self.parse.get('known_errors', known)
+    def has_section(self, section):
+        return section in ReadConfig.options
+
+    # Return the compiled space_threshold or traffic_threshold for a Nexenta, or None if
+    # not configured.
+    def thresholds(self, option, hostname):
+        if not self.has_section(hostname):
+            raise CritError("%s not defined in config file!" % hostname)
+        thresholds = ReadConfig.compiled.get((option, hostname))
+        if isinstance(thresholds, CritError):
+            raise thresholds
+        return thresholds
+
+    # Return all Nexentas configured in the config file.
+    def hostnames(self):
+        return [section for section, options in ReadConfig.sections if section not in ('daemon', 'known_errors')]
+
+    # Return the compiled known errors, the DEFAULT entry is kept apart from the messages.
+    def known_errors(self):
+        return ReadConfig.compiled['known_errors']
+
+
+class SpaceThresholds:
+    # space_threshold compiled once into exact folder names, glob patterns like
+    # pool0/home/* (matched in config order) and DEFAULT. Limits are converted to
+    # ('%', percentage) or ('B', bytes) up front, IGNORE becomes None.
+    option = 'space_threshold'
+
+    def __init__(self, hostname, thresholds):
+        self.exact = {}
+        self.patterns = []
+        self.default = None
+
+        for threshold in thresholds.split('\n'):
+            threshold = threshold.strip()
+            if not threshold:
+                continue
+
+            fields = threshold.split(';')
+            try:
+                limits = self.parse_fields(fields[1:])
+            except ValueError:
+                raise CritError("Error in config file at [%s]:%s, line %s" % (hostname, self.option, threshold))
+
+            folder = fields[0]
+            if folder == "DEFAULT":
+                self.default = limits
+            elif [char for char in "*?[" if char in folder]:
+                self.patterns.append((folder, limits))
+            else:
+                self.exact[folder] = limits
+
+    # Check/extend the thresholds, the snapshot thresholds are optional.
+    def parse_fields(self, fields):
+        if len(fields) == 2:
+            fields = fields + ["IGNORE", "IGNORE"]
+        elif len(fields) != 4:
+            raise ValueError(fields)
+        return [self.parse_limit(limit) for limit in fields]
+
+    def parse_limit(self, limit):
+        limit = limit.strip().upper()
+        if limit == "IGNORE":
+            return None
+        if limit[-1:] == '%':
+            return ('%', float(limit[:-1]))
+        if limit[-1:] in "BKMGT" and convert_space(limit):
+            return ('B', convert_space(limit))
+        raise ValueError(limit)
+
+    # Return the volwarn, volcrit, snapwarn and snapcrit limits for a folder, or None if
+    # the folder should not be checked.
+    def lookup(self, vol):
+        limits = self.exact.get(vol)
+        if limits:
+            return limits
+        for pattern, limits in self.patterns:
+            if fnmatch.fnmatchcase(vol, pattern):
+                return limits
+        return self.default
+
+
+class TrafficThresholds(SpaceThresholds):
+    # traffic_threshold, looked up by interface name like space_threshold by folder. Limits
+    # are rates in bit/s with an optional K, M, G or T (powers of 1000), or IGNORE. The
+    # thresholds apply to both directions, unless separate ones are given for out.
+    option = 'traffic_threshold'
+
+    def parse_fields(self, fields):
+        if len(fields) == 2:
+            fields = fields + fields
+        elif len(fields) != 4:
+            raise ValueError(fields)
+        return [self.parse_limit(limit) for limit in fields]
+
+    def parse_limit(self, limit):
+        limit = limit.strip().upper()
+        if limit == "IGNORE":
+            return None
+        if limit[-1:] in "KMGT":
+            return float(limit[:-1]) * 1000 ** ("KMGT".index(limit[-1]) + 1)
+        return float(limit)
+
+
+class ForecastThresholds(SpaceThresholds):
+    # forecast_threshold, looked up by folder like space_threshold. Limits are the number of
+    # days until a folder is forecast to be full, or IGNORE.
+    option = 'forecast_threshold'
+
+    def parse_fields(self, fields):
+        if len(fields) != 2:
+            raise ValueError(fields)
+        return [self.parse_limit(limit) for limit in fields]
+
+    def parse_limit(self, limit):
+        limit = limit.strip().upper()
+        if limit == "IGNORE":
+            return None
+        return float(limit)
+
+
+class KnownErrors:
+    # [known_errors] compiled once into an Aho-Corasick automaton over the lowercased
+    # messages, so classifying a fault is a single pass over its description, however
+    # many messages are configured. If several messages match, the one listed first in
+    # the config file is used. Entries are split into severity and description up front,
+    # an invalid entry is only reported when a fault matches it.
+    def __init__(self, entries, default):
+        self.entries = []
+        self.goto = [{}]
+        self.fail = [0]
+        self.first = [None]
+
+        for message, value in entries:
+            self.add(message.lower(), len(self.entries))
+            self.entries.append(self.parse(value, True))
+        self.link()
+
+        self.default = None
+        if default:
+            self.default = self.parse(default, False)
+
+    # Split an entry into (severity, description, error).
+    def parse(self, value, check_severity):
+        try:
+            severity, description = value.split(';')
+        except ValueError:
+            return None, None, "Error in config file at [known_errors], line: %s" % value
+
+        if check_severity and not severity.upper() in ("DEFAULT", "WARNING", "CRITICAL", "UNKNOWN", "IGNORE"):
+            return None, None, "Invalid severity in config file at [known_errors], line: %s" % value
+        return severity.upper(), description, None
+
+    # Add a message to the trie, <first> keeps the lowest position of the messages ending at a node.
+    def add(self, message, position):
+        node = 0
+        for char in message:
+            if char not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.first.append(None)
+                self.goto[node][char] = len(self.goto) - 1
+            node = self.goto[node][char]
+        if self.first[node] is None:
+            self.first[node] = position
+
+    # Set the failure links breadth first, and merge <first> of the suffixes into every node.
+    def link(self):
+        queue = self.goto[0].values()
+        while queue:
+            node = queue.pop(0)
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                if node:
+                    self.fail[child] = self.goto[fail].get(char, 0)
+                suffix = self.first[self.fail[child]]
+                if suffix is not None and (self.first[child] is None or suffix < self.first[child]):
+                    self.first[child] = suffix
+                queue.append(child)
+
+    def get(self, entry):
+        severity, description, error = entry
+        if error:
+            raise CritError(error)
+        return severity, description
+
+    # Return the severity and description of the first configured message that is part
+    # of the message, or empty strings if none matches.
+    def match(self, message):
+        node = 0
+        first = None
+        for char in message.lower():
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if self.first[node] is not None and (first is None or self.first[node] < first):
+                first = self.first[node]
+
+        if first is None:
+            return "", ""
+        return self.get(self.entries[first])
+
+
+class HttpPool:
+    # Keep up to <size> idle HTTP/1.1 connections open to one NMS, so calls reuse the
+    # TCP connection (and the TLS session when using SSL) instead of connecting each time.
+    # At most <concurrency> requests are sent to the NMS at the same time, whichever
+    # check they are made for.
+    def __init__(self, host, port, size, concurrency, ctx=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.ctx = ctx
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def connect(self):
+        import httplib
+        if self.ctx:
+            return httplib.HTTPSConnection(self.host, self.port, context=self.ctx)
+        return httplib.HTTPConnection(self.host, self.port)
+
+    # Take an idle connection from the pool, or open a new one.
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop(), True
+        finally:
+            self.lock.release()
+        return self.connect(), False
+
+    # Return a connection to the pool, close it if the pool is full.
+    def release(self, conn):
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    # Send the request and return the connection and response once the headers are in, waiting
+    # at most timeout seconds. A reused connection may have been closed by NMS in the meantime,
+    # so retry on a fresh connection if the peer closed it, within what is left of the timeout.
+    # Other errors, like a timeout, are not retried, NMS may still be working on the request.
+    # NMS is done with the request once the headers are in, so the body is read without
+    # holding one of the <concurrency> slots.
+    def open(self, path, body, headers, timeout):
+        import errno
+        import httplib
+        import socket
+        deadline = time.time() + timeout
+        while True:
+            conn, reused = self.acquire()
+            conn.timeout = max(deadline - time.time(), 0.001)
+            if conn.sock:
+                conn.sock.settimeout(conn.timeout)
+            self.slots.acquire()
+            try:
+                try:
+                    conn.request('POST', path, body, headers)
+                    response = conn.getresponse()
+                except (httplib.HTTPException, socket.error), error:
+                    conn.close()
+                    if reused and (isinstance(error, httplib.BadStatusLine) or
+                                   error.args and error.args[0] in (errno.ECONNRESET, errno.EPIPE)):
+                        continue
+                    raise
+            finally:
+                self.slots.release()
+
+            if response.status != 200:
+                self.finish(conn, response, True)
+                raise httplib.HTTPException("HTTP %s %s" % (response.status, response.reason))
+            return conn, response
+
+    # Return the connection to the pool once the response has been read, or close it if the
+    # response was not read to the end.
+    def finish(self, conn, response, complete):
+        import httplib
+        import socket
+        if complete and not response.will_close:
+            try:
+                response.read()
+                self.release(conn)
+                return
+            except (httplib.HTTPException, socket.error):
+                pass
+        conn.close()
+
+    # Post the body and return the response body.
+    def post(self, path, body, headers, timeout):
+        import httplib
+        import socket
+        conn, response = self.open(path, body, headers, timeout)
+        try:
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+        self.finish(conn, response, True)
+        return data
+
+
+class JsonStream:
+    # Decode a JSON response of NMS while it is read, so a large result is never held as one
+    # string. open() decodes the members up to the result, results() then decodes a list or
+    # dict result one item at a time, reading <chunk> bytes at a time.
+    whitespace = re.compile(r'[ \t\r\n]*')
+
+    def __init__(self, read, chunk=16384):
+        self.scan = import_json().JSONDecoder().scan_once
+        self.read = read
+        self.chunk = chunk
+        self.buffer = ''
+        self.pos = 0
+        self.size = 0
+        self.eof = False
+        self.envelope = {'result': None, 'error': None}
+        self.container = None
+
+    # Read the next chunk and drop what has been decoded. Return False at the end of the response.
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.read(self.chunk)
+        if not data:
+            self.eof = True
+            return False
+        self.size += len(data)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    # Return the next character that is not whitespace, without consuming it.
+    def peek(self):
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of response")
+
+    # Consume the next character, which must be one of <chars>, and return it.
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected one of %s at offset %s" % (chars, self.size - len(self.buffer) + self.pos))
+        self.pos += 1
+        return char
+
+    # Decode the next value, reading on until it is complete. A number may be cut in two by
+    # the end of the buffer, so a value is only accepted if followed by a character that can
+    # not be part of a number, or at the end of the response.
+    def value(self):
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            try:
+                value, end = self.scan(self.buffer, self.pos)
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in '0123456789+-.eE'):
+                    self.pos = end
+                    return value
+            except (StopIteration, ValueError):
+                if self.eof:
+                    raise ValueError("No JSON value at offset %s" % (self.size - len(self.buffer) + self.pos))
+            self.fill()
+
+    # Decode the members of the response up to a list or dict result, or up to the end.
+    def members(self):
+        while True:
+            key = self.value()
+            self.expect(':')
+            if key == 'result' and self.peek() in '[{':
+                self.container = self.expect('[{')
+                return self.envelope
+            self.envelope[key] = self.value()
+            if self.expect(',}') == '}':
+                return self.envelope
+
+    # Return the members of the response, a list or dict result is left to results().
+    def open(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return self.envelope
+        return self.members()
+
+    # Yield the items of a list result, or the (key, value) pairs of a dict result, then
+    # decode the members after the result.
+    def results(self):
+        close = {'[': ']', '{': '}'}[self.container]
+        skip = self.whitespace.match
+        scan = self.scan
+        if self.peek() == close:
+            self.pos += 1
+        else:
+            while True:
+                if self.container == '{':
+                    key = self.value()
+                    self.expect(':')
+                    yield key, self.value()
+                    separator = self.expect(',}')
+                else:
+                    # Decode list items within the buffer inline, as lists can be long. An item
+                    # followed by a separator is complete, otherwise fall back to value().
+                    buffer = self.buffer
+                    try:
+                        item, end = scan(buffer, skip(buffer, self.pos).end())
+                        end = skip(buffer, end).end()
+                        separator = buffer[end]
+                    except (StopIteration, ValueError, IndexError):
+                        separator = None
+                    if separator and separator in ',]':
+                        self.pos = end + 1
+                    else:
+                        item = self.value()
+                        separator = self.expect(',]')
+                    yield item
+                if separator == close:
+                    break
+        self.container = None
+        if self.expect(',}') == ',':
+            self.members()
+
+
+class StreamResult:
+    # Iterates over the items of a streamed result and returns the connection to the pool
+    # once it is read to the end. The connection is closed if reading fails, or if the result
+    # is closed or dropped before the end. Not a generator, as Python 2.4 does not allow
+    # yield inside try/finally.
+    def __init__(self, pool, url, stream, conn, reply, done):
+        self.pool = pool
+        self.url = url
+        self.stream = stream
+        self.items = stream.results()
+        self.conn = conn
+        self.reply = reply
+        self.done = done
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        import httplib
+        import socket
+        if self.closed:
+            raise StopIteration
+        try:
+            return self.items.next()
+        except StopIteration:
+            self.close(True)
+            if self.stream.envelope['error']:
+                raise CritError("API error occured: %s" % self.stream.envelope['error'])
+            raise StopIteration
+        except ValueError:
+            self.close()
+            raise CritError("Invalid response from API at %s" % (self.url))
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            raise CritError("Unable to connect to API at %s" % (self.url))
+        except:
+            error = sys.exc_info()
+            self.close()
+            raise error[0], error[1], error[2]
+
+    def close(self, complete=False):
+        if not self.closed:
+            self.closed = True
+            self.pool.finish(self.conn, self.reply, complete)
+            self.done(self.stream.size)
+
+    def __del__(self):
+        self.close()
+
+
+class ResponseCache:
+    # API results kept on disk between runs, so checks run shortly after each other share
+    # them. Every result is stored in its own file, written to a temporary file and renamed
+    # so readers never see a partial file. The file mtime is the last use, which is used to
+    # evict the least recently used results once the cache grows beyond <size> bytes. The
+    # cache is only scanned by the first put of a run, after that the bytes written are
+    # added to the total, and it is scanned again once that passes <size>. A cache that can
+    # not be used does not fail the check, results are fetched uncached.
+    def __init__(self, directory, ttls, size):
+        self.directory = directory
+        self.ttls = ttls
+        self.size = size
+        self.total = None
+        self.counting = threading.Lock()
+
+    # Return the TTL configured for <object>.<method>, or None if it should not be cached.
+    def ttl(self, obj, meth):
+        return self.ttls.get('%s.%s' % (obj, meth))
+
+    def key(self, *args):
+        try:
+            from hashlib import sha1
+        except ImportError:
+            from sha import new as sha1
+        return sha1(import_json().dumps(args)).hexdigest()
+
+    # Lock one of 256 lock files, so processes fetching the same result wait for each other.
+    def lock(self, key):
+        make_state_dir(os.path.dirname(self.directory))
+        make_state_dir(self.directory)
+        lockfile = open(os.path.join(self.directory, '.lock-%s' % key[:2]), 'a')
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        return lockfile
+
+    def unlock(self, lockfile):
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+
+    # Return the cached result if it is not older than ttl, or None.
+    def get(self, key, ttl):
+        path = os.path.join(self.directory, key)
+        try:
+            cached = open_state(path)
+            try:
+                entry = import_json().load(cached)
+            finally:
+                cached.close()
+        except (IOError, ValueError):
+            return None
+
+        if entry['time'] + ttl < time.time():
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    # Cache a result, a failure only means it is fetched again.
+    def put(self, key, result):
+        data = import_json().dumps({'time': time.time(), 'result': result})
+        try:
+            write_file(os.path.join(self.directory, key), data)
+        except (OSError, IOError):
+            return
+        self.counting.acquire()
+        try:
+            if self.total is not None:
+                self.total += len(data)
+            if self.total is None or self.total > self.size:
+                self.total = self.evict()
+        finally:
+            self.counting.release()
+
+    # Once the cache grows beyond <size> bytes, remove the least recently used results until
+    # it fits in 3/4 of it, so the next scan is a while off. Returns the size of the cache.
+    def evict(self):
+        try:
+            lockfile = self.lock('evict')
+        except (OSError, IOError):
+            return 0
+        try:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if name.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+
+            if total > self.size:
+                entries.sort()
+                while entries and total > self.size * 3 / 4:
+                    mtime, size, name = entries.pop(0)
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+                    total -= size
+            return total
+        finally:
+            self.unlock(lockfile)
+
+    # Return the cached result for key, or call fetch and cache its result. Only one
+    # process fetches a result at a time, others wait and use the result it cached.
+    def fetch(self, key, ttl, fetch):
+        entry = self.get(key, ttl)
+        if entry:
+            return entry['result']
+
+        try:
+            lockfile = self.lock(key)
+        except (OSError, IOError):
+            return fetch()
+        try:
+            entry = self.get(key, ttl)
+            if entry:
+                return entry['result']
+            result = fetch()
+            self.put(key, result)
+            return result
+        finally:
+            self.unlock(lockfile)
+
+
+class CircuitBreaker:
+    # Keeps the number of consecutive runs in which NMS of a Nexenta failed in a state file.
+    # Once <threshold> runs failed the breaker opens and API calls fail at once with UNKNOWN.
+    # After <probe> seconds one run is allowed to try NMS again, if it succeeds the breaker
+    # closes, if not it stays open for another <probe> seconds.
+    def __init__(self, path, threshold, probe):
+        self.path = path
+        self.threshold = threshold
+        self.probe = probe
+        self.lock = threading.Lock()
+        self.failed = False
+        self.probing = False
+        self.tripped = False
+
+        # Claim the probe under a lock, so only one run probes a Nexenta at a time.
+        try:
+            make_state_dir(os.path.dirname(self.path))
+            lockfile = open(self.path + '.lock', 'a')
+        except (OSError, IOError), error:
+            raise UnknownError("Can not keep the NMS circuit breaker state in %s: %s" % (self.path, error))
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            self.state = self.load()
+            if self.is_open() and self.state['opened'] + self.probe <= time.time():
+                self.state['opened'] = time.time()
+                self.save()
+                self.probing = True
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+
+    def load(self):
+        try:
+            statefile = open_state(self.path)
+            try:
+                return import_json().load(statefile)
+            finally:
+                statefile.close()
+        except (IOError, ValueError):
+            return {'failures': 0, 'opened': 0}
+
+    def save(self):
+        try:
+            write_file(self.path, import_json().dumps(self.state))
+        except (OSError, IOError), error:
+            raise UnknownError("Can not keep the NMS circuit breaker state in %s: %s" % (self.path, error))
+
+    def is_open(self):
+        return self.state['failures'] >= self.threshold
+
+    # Raise UNKNOWN if API calls should not be made.
+    def check(self):
+        if self.is_open() and not self.probing:
+            self.tripped = True
+            raise UnknownError("NMS circuit breaker OPEN after %s failed runs, next probe at %s" % (
+                               self.state['failures'], time.strftime('%H:%M:%S', time.localtime(
+                               self.state['opened'] + self.probe))))
+
+    def success(self):
+        if self.state['failures'] and not self.failed:
+            self.lock.acquire()
+            try:
+                if self.state['failures'] and not self.failed:
+                    self.state = {'failures': 0, 'opened': 0}
+                    self.probing = False
+                    self.save()
+            finally:
+                self.lock.release()
+
+    # Count the failure once per run, and open the breaker when the threshold is reached.
+    def failure(self):
+        self.lock.acquire()
+        try:
+            if not self.failed:
+                self.failed = True
+                self.probing = False
+                self.state['failures'] += 1
+                if self.state['failures'] == self.threshold or self.is_open() and not self.state['opened']:
+                    self.state['opened'] = time.time()
+                self.save()
+        finally:
+            self.lock.release()
+
+    # Return the state for the check output, with the failed runs counted so far while the
+    # breaker is closed.
+    def status(self):
+        if self.is_open():
+            return "NMS circuit breaker OPEN"
+        if self.state['failures']:
+            return "NMS circuit breaker closed, %s of %s failed runs" % (self.state['failures'], self.threshold)
+        return "NMS circuit breaker closed"
+
+
+class RecordFile:
+    # A file in state_dir of fixed size records keyed by name, behind a header with magic,
+    # the fields of the caller and the number of records used. The file is mapped into
+    # memory and records are read and written in place, so a run touches only the records
+    # it needs however many there are. The file is locked while open and doubles in size
+    # when all records are used, records that are not needed anymore are pruned by the
+    # caller. Names longer than 48 bytes are shortened with a checksum.
+    def __init__(self, path, magic, header, record):
+        import struct
+        self.path = path
+        self.magic = magic
+        self.header = '<8s%sI' % header
+        self.record = '<48s%s' % record
+        self.header_size = struct.calcsize(self.header)
+        self.record_size = struct.calcsize(self.record)
+
+    # Open and lock the file, and return the fields of the header, or None if the file is
+    # new or was written in another format.
+    def open(self):
+        import mmap
+        import struct
+        make_state_dir(os.path.dirname(self.path))
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            if not trusted(os.fstat(self.fd)):
+                raise OSError("%s is not owned by this user or writable by others" % self.path)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            self.size = os.fstat(self.fd).st_size
+            if self.size < self.header_size + self.record_size:
+                self.size = self.header_size + 64 * self.record_size
+                os.ftruncate(self.fd, self.size)
+            self.store = mmap.mmap(self.fd, self.size)
+        except:
+            os.close(self.fd)
+            raise
+
+        fields = struct.unpack(self.header, self.store[:self.header_size])
+        self.clear()
+        if fields[0] != self.magic:
+            return None
+        for slot in range(min(fields[-1], (self.size - self.header_size) / self.record_size)):
+            offset = self.header_size + slot * self.record_size
+            self.slots[self.store[offset:offset + 48].rstrip('\0')] = offset
+        return fields[1:-1]
+
+    # Forget all records, their space is used again.
+    def clear(self):
+        self.slots = {}
+
+    # Return the keys of all records, get() accepts them as names.
+    def names(self):
+        return self.slots.keys()
+
+    # Drop the records of all names not given, move the others to the front in the same
+    # order and shrink the file if less than half of it is used.
+    def prune(self, names):
+        import mmap
+        keep = dict([(self.key(name), True) for name in names])
+        if not [key for key in self.slots if key not in keep]:
+            return
+        records = [(offset, key) for key, offset in self.slots.items() if key in keep]
+        records.sort()
+        self.slots = {}
+        for offset, key in records:
+            moved = self.header_size + len(self.slots) * self.record_size
+            if moved != offset:
+                self.store[moved:moved + self.record_size] = self.store[offset:offset + self.record_size]
+            self.slots[key] = moved
+
+        size = self.header_size + max(64, 2 * len(self.slots)) * self.record_size
+        if size < self.size:
+            self.store.close()
+            os.ftruncate(self.fd, size)
+            self.size = size
+            self.store = mmap.mmap(self.fd, self.size)
+
+    def key(self, name):
+        import zlib
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        if len(name) > 48:
+            return '%s%08x' % (name[:40], zlib.crc32(name) & 0xffffffff)
+        return name
+
+    # Return the fields of the record of name, or None if it has no record.
+    def get(self, name):
+        import struct
+        offset = self.slots.get(self.key(name))
+        if offset is None:
+            return None
+        return struct.unpack(self.record, self.store[offset:offset + self.record_size])[1:]
+
+    def put(self, name, fields):
+        import mmap
+        import struct
+        key = self.key(name)
+        offset = self.slots.get(key)
+        if offset is None:
+            offset = self.header_size + len(self.slots) * self.record_size
+            if offset + self.record_size > self.size:
+                self.store.close()
+                self.size = self.header_size + 2 * len(self.slots) * self.record_size
+                os.ftruncate(self.fd, self.size)
+                self.store = mmap.mmap(self.fd, self.size)
+            self.slots[key] = offset
+        self.store[offset:offset + self.record_size] = struct.pack(self.record, key, *fields)
+
+    # Write the header and close the file, which releases the lock.
+    def close(self, fields):
+        import struct
+        try:
+            self.store[:self.header_size] = struct.pack(self.header, *((self.magic,) + tuple(fields) +
+                                                                       (len(self.slots),)))
+        finally:
+            self.store.close()
+            os.close(self.fd)
+
+
+class CounterStore:
+    # The traffic counters of the previous run of a Nexenta, kept in state_dir with the
+    # boot time of the Nexenta, and per interface the time of the sample and the in and
+    # out octets.
+    def __init__(self, path):
+        self.path = path
+        self.records = RecordFile(path, 'CNXCTR01', 'd', 'dQQ')
+
+    # Return the octets moved between two readings of a 64 bit counter, or None if the
+    # counter was reset. Only a counter close to its maximum is taken to have wrapped.
+    def delta(self, old, new):
+        if new >= old:
+            return new - old
+        if old >= 2 ** 63:
+            return new + 2 ** 64 - old
         return None
 
+    # Store the samples, a list of (interface, in octets, out octets) read at <now>, and
+    # return the in and out rates in bit/s since the previous sample of each interface.
+    # Interfaces seen for the first time, or with a counter reset, get no rates. A change
+    # in boot time means the Nexenta was rebooted, all previous samples are dropped then.
+    # Interfaces that are gone are dropped.
+    def update(self, boot, now, samples):
+        stored = self.records.open()
+        try:
+            if not stored or abs(boot - stored[0]) > 60:
+                self.records.clear()
+
+            rates = {}
+            for interface, inoctets, outoctets in samples:
+                inoctets, outoctets = inoctets % 2 ** 64, outoctets % 2 ** 64
+                last = self.records.get(interface)
+                if last:
+                    indelta = self.delta(last[1], inoctets)
+                    outdelta = self.delta(last[2], outoctets)
+                    if now > last[0] and indelta is not None and outdelta is not None:
+                        rates[interface] = (indelta * 8 / (now - last[0]), outdelta * 8 / (now - last[0]))
+                self.records.put(interface, (now, inoctets, outoctets))
+            self.records.prune([interface for interface, inoctets, outoctets in samples])
+        finally:
+            self.records.close((boot,))
+        return rates
+
+
+class UsageHistory:
+    # The space used by folders of a Nexenta over the last <days>, kept in state_dir in a
+    # ring of a sample per hour for each folder. Each record also keeps the sums the least
+    # squares fit needs, updated as samples come and go, so a forecast does not go over
+    # the samples. The sums are made again from the samples each time the ring wraps, so
+    # rounding does not add up. Sample times are kept in seconds since the file was
+    # started, which keeps the sums small.
+    interval = 3600
+
+    def __init__(self, path, days):
+        self.path = path
+        self.slots = int(days * 24)
+        self.records = RecordFile(path, 'CNXUSE01', 'dI', 'II4d%sd' % (2 * self.slots))
+
+    # Drop the records of folders not in samples whose last sample is older than the ring.
+    def prune(self, sampled, samples):
+        current = dict([(self.records.key(vol), True) for vol, used, available in samples])
+        keep = []
+        for name in self.records.names():
+            if name not in current:
+                ring = self.records.get(name)
+                if sampled - ring[6 + (ring[1] - 1) % self.slots] >= self.slots * UsageHistory.interval:
+                    continue
+            keep.append(name)
+        self.records.prune(keep)
+
+    # Return the rate in bytes per second at which used grows, fitted with least squares,
+    # or None if there are fewer than 12 samples.
+    def rate(self, count, sumtimes, sumused, sumsquares, sumproducts):
+        if count < 12:
+            return None
+        variance = count * sumsquares - sumtimes * sumtimes
+        if variance <= 0:
+            return None
+        return (count * sumproducts - sumtimes * sumused) / variance
+
+    # Add the samples, a list of (folder, used, available) in bytes read at <now>, unless
+    # the last sample of a folder is less than an hour old. Return per folder the seconds
+    # until it is full at the fitted rate, if it is filling up. When samples were added,
+    # folders without a sample for <days>, like removed folders, are dropped.
+    def forecast(self, now, samples):
+        import operator
+        stored = self.records.open()
+        try:
+            if not stored or stored[1] != self.slots:
+                self.records.clear()
+                stored = (now, self.slots)
+            sampled = now - stored[0]
+
+            full = {}
+            added = False
+            for vol, used, available in samples:
+                ring = self.records.get(vol)
+                if not ring:
+                    ring = (0, 0, 0.0, 0.0, 0.0, 0.0) + (0.0,) * (2 * self.slots)
+                count, head = ring[:2]
+                sums = list(ring[2:6])
+
+                if not count or sampled - ring[6 + (head - 1) % self.slots] >= UsageHistory.interval:
+                    times = list(ring[6:6 + self.slots])
+                    values = list(ring[6 + self.slots:])
+
+                    # Drop the sample overwritten in a full ring, and add the new one.
+                    if count == self.slots:
+                        sums = [sums[0] - times[head], sums[1] - values[head], sums[2] - times[head] ** 2,
+                                sums[3] - times[head] * values[head]]
+                    else:
+                        count += 1
+                    times[head] = sampled
+                    values[head] = used
+                    sums = [sums[0] + sampled, sums[1] + used, sums[2] + sampled ** 2, sums[3] + sampled * used]
+
+                    head = (head + 1) % self.slots
+                    if not head:
+                        sums = [sum(times[:count]), sum(values[:count]),
+                                sum(map(operator.mul, times[:count], times[:count])),
+                                sum(map(operator.mul, times[:count], values[:count]))]
+                    self.records.put(vol, [count, head] + sums + times + values)
+                    added = True
+
+                rate = self.rate(count, *sums)
+                if rate and rate > 0:
+                    full[vol] = available / rate
+
+            if added:
+                self.prune(sampled, samples)
+        finally:
+            self.records.close(stored)
+        return full
+
 
 class NexentaApi:
+    # Connection pools shared by all NexentaApi instances, one per NMS.
+    pools = {}
+    pools_lock = threading.Lock()
+
     # Get the connection info and build the api url.
     def __init__(self, nexenta):
         cfg = ReadConfig()
         username = cfg.get_option(nexenta['hostname'], 'api_user')
         password = cfg.get_option(nexenta['hostname'], 'api_pass')
         self.nms_retry = cfg.get_option(nexenta['hostname'], 'nms_retry')
+        pool_size = cfg.get_option(nexenta['hostname'], 'api_pool_size')
+        concurrency = cfg.get_option(nexenta['hostname'], 'api_concurrency')
 
         if not username or not password:
             raise CritError("No connection info configured for %s" % nexenta['hostname'])
         if not self.nms_retry:
             self.nms_retry = 2
-        
+        if not pool_size:
+            pool_size = 4
+        if not concurrency:
+            concurrency = 4
+
+        port = cfg.get_option(nexenta['hostname'], 'api_port')
+        if not port:
+            port = 2000
+
         ssl = cfg.get_option(nexenta['hostname'], 'api_ssl')
         insecure = cfg.get_option(nexenta['hostname'], 'api_ssl_insecure')
-        self.https = False
         if ssl != "ON":
             protocol = 'http'
         else:
-            import ssl 
             protocol = 'https'
-            self.https = True
-            if insecure == "ON":
-                self.ctx = ssl.create_default_context()
-                self.ctx.check_hostname = False
-                self.ctx.verify_mode = ssl.CERT_NONE
-            else:
-                self.ctx = ssl.create_default_context()
-            
-        port = cfg.get_option(nexenta['hostname'], 'api_port')
-        if not port:
-            port = 2000
 
+        import base64
         self.base64_string = base64.encodestring('%s:%s' % (username, password))[:-1]
-        self.url = '%s://%s:%s/rest/nms/ <%s://%s:%s/rest/nms/>' % (protocol, nexenta['ip'], port, protocol, 
-                                                                    nexenta['ip'], port)
+        self.path = '/rest/nms/'
+        self.hostname = nexenta['hostname']
+        self.identity = nexenta.get('identity', nexenta['hostname'])
+        self.deadline = nexenta['deadline']
+        self.breaker = nexenta.get('breaker')
+        self.stats = nexenta.get('stats')
+
+        # Cache results on disk between runs, if TTLs are configured in the config file.
+        self.cache = None
+        ttls = cfg.get_option(nexenta['hostname'], 'api_cache_ttl')
+        if ttls:
+            cache_ttls = {}
+            for ttl in ttls.split('\n'):
+                if not ttl:
+                    continue
+                try:
+                    method, seconds = ttl.split(';')
+                    cache_ttls[method.strip()] = int(seconds)
+                except ValueError:
+                    raise CritError("Error in config file at [%s]:api_cache_ttl, line %s" % (nexenta['hostname'], ttl))
+
+            size = cfg.get_option(nexenta['hostname'], 'api_cache_size')
+            if not size:
+                size = "10M"
+            self.cache = ResponseCache(os.path.join(state_dir(nexenta), 'cache'), cache_ttls, convert_space(size))
+        self.url = '%s://%s:%s%s' % (protocol, nexenta['ip'], port, self.path)
 
-    # Build the request and return the response.
+        # Share one pool between all instances for this NMS.
+        NexentaApi.pools_lock.acquire()
+        try:
+            self.pool = NexentaApi.pools.get(self.url)
+            if not self.pool:
+                ctx = None
+                if protocol == 'https':
+                    import ssl
+                    ctx = ssl.create_default_context()
+                    if insecure == "ON":
+                        ctx.check_hostname = False
+                        ctx.verify_mode = ssl.CERT_NONE
+                self.pool = HttpPool(nexenta['ip'], int(port), int(pool_size), int(concurrency), ctx)
+                NexentaApi.pools[self.url] = self.pool
+        finally:
+            NexentaApi.pools_lock.release()
+
+    # Return the response, from the cache if configured for this method.
     def get_data(self, obj, meth, par):
+        if self.cache and self.cache.ttl(obj, meth):
+            key = self.cache.key(self.identity, obj, meth, par)
+            return self.cache.fetch(key, self.cache.ttl(obj, meth), lambda: self.request(obj, meth, par))
+        return self.request(obj, meth, par)
+
+    # Return an iterator over the result, decoded while the response is read: the items of a
+    # list result, or the (key, value) pairs of a dict result. Cached methods are read from
+    # the cache as a whole.
+    def iter_data(self, obj, meth, par):
+        if self.cache and self.cache.ttl(obj, meth):
+            result = self.get_data(obj, meth, par)
+        else:
+            result = self.request(obj, meth, par, stream=True)
+        if isinstance(result, dict):
+            return result.iteritems()
+        return iter(result or [])
+
+    # Build the request and return the response, unless the circuit breaker is open. Only
+    # NMS failing to answer counts for the breaker, the UNKNOWN of the check deadline does
+    # not, NMS may not even have been called then.
+    def request(self, obj, meth, par, stream=False):
         data = {'object': obj, 'method': meth, 'params': par}
-        data = json.dumps(data)
-        request = urllib2.Request(self.url, data)
-        request.add_header('Authorization', 'Basic %s' % self.base64_string)
-        request.add_header('Content-Type' , 'application/json')
-
-        # Try to connect max <nms_retry> times. Sleep 20 seconds if NMS connection error occurs.
-        tries = int(self.nms_retry)
-        while tries:
-            try:
-                if self.https:
-                    response = json.loads(urllib2.urlopen(request, context=self.ctx).read())
-                else:
-                    response = json.loads(urllib2.urlopen(request).read())
+        data = import_json().dumps(data)
+        headers = {'Authorization': 'Basic %s' % self.base64_string,
+                   'Content-Type': 'application/json',
+                   'Connection': 'keep-alive'}
 
-                if response['error'] and "Cannot introspect object com.nexenta.nms" in response['error']['message']:
-                    raise Exception("NMS unresponsive")
-                break
-            except (urllib2.URLError, Exception):
-                tries += -1
-                time.sleep(20)
-
-        if not tries:
-            raise CritError("Unable to connect to API at %s" % (self.url))
+        if self.breaker:
+            self.breaker.check()
+            try:
+                response = self.call(obj, meth, data, headers, stream)
+            except CritError:
+                self.breaker.failure()
+                raise
+            self.breaker.success()
+        else:
+            response = self.call(obj, meth, data, headers, stream)
 
         if response['error']:
             #raise
@@ -192,46 +1300,815 @@ class NexentaApi:
         else:
             return response['result']
 
+    # Send the request and decode the response up to the result. A list or dict result is
+    # replaced by an iterator decoding it while it is read.
+    def open_stream(self, data, headers, timeout, done):
+        conn, reply = self.pool.open(self.path, data, headers, timeout)
+        stream = JsonStream(reply.read)
+        try:
+            response = stream.open()
+        except:
+            self.pool.finish(conn, reply, False)
+            raise
+        if stream.container:
+            response['result'] = StreamResult(self.pool, self.url, stream, conn, reply, done)
+        else:
+            self.pool.finish(conn, reply, True)
+        return response, stream
+
+    # Post the request and return the decoded response. Retry max <nms_retry> times if the
+    # connection fails or NMS is unresponsive, with jittered exponential backoff between the
+    # tries, but give up with UNKNOWN once the check deadline has been reached. A streamed
+    # result is recorded in the stats once it has been read.
+    def call(self, obj, meth, data, headers, stream=False):
+        import httplib
+        import random
+        import socket
+        started = time.time()
+        size = 0
+        retries = 0
+        streaming = False
+
+        def done(size):
+            if self.stats:
+                self.stats.record('nms', '%s.%s' % (obj, meth), started, size, retries)
+
+        try:
+            tries = int(self.nms_retry)
+            delay = 2
+            while True:
+                timeout = self.deadline - time.time()
+                if timeout <= 0:
+                    raise UnknownError("Check deadline reached before API call %s.%s" % (obj, meth))
+
+                try:
+                    if stream:
+                        try:
+                            response, decoder = self.open_stream(data, headers, timeout, done)
+                        except ValueError:
+                            raise CritError("Invalid response from API at %s" % (self.url))
+                        size = decoder.size
+                        streaming = decoder.container is not None
+                    else:
+                        body = self.pool.post(self.path, data, headers, timeout)
+                        size = len(body)
+                        try:
+                            response = import_json().loads(body)
+                        except ValueError:
+                            raise CritError("Invalid response from API at %s" % (self.url))
+
+                    if not (response['error'] and "Cannot introspect object com.nexenta.nms" in response['error']['message']):
+                        return response
+                except (httplib.HTTPException, socket.error):
+                    pass
+
+                tries += -1
+                if not tries:
+                    raise CritError("Unable to connect to API at %s" % (self.url))
+
+                sleep = delay / 2.0 + random.uniform(0, delay / 2.0)
+                if time.time() + sleep >= self.deadline:
+                    raise UnknownError("Check deadline reached while retrying API at %s" % (self.url))
+                slept = time.time()
+                time.sleep(sleep)
+                if self.stats:
+                    self.stats.record('sleep', '%s.%s' % (obj, meth), slept)
+                delay = min(delay * 2, 20)
+                retries += 1
+        finally:
+            if not streaming:
+                done(size)
+
+
+class CallStats:
+    # Timing of every API, SNMP and DNS call of a run and of the sleeps between API retries,
+    # for the self-monitoring perfdata and the trace file.
+    def __init__(self):
+        self.start = time.time()
+        self.calls = []
+
+    # Record a call started at <started>, size is in bytes for API calls and in varbinds
+    # for SNMP requests.
+    def record(self, kind, name, started, size=0, retries=0):
+        self.calls.append((started - self.start, kind, name, time.time() - started, size, retries))
+
+    # Return the number of calls, total time, total size and total retries of a kind.
+    def totals(self, kind):
+        count, spent, size, retries = 0, 0.0, 0, 0
+        for call in self.calls:
+            if call[1] == kind:
+                count += 1
+                spent += call[3]
+                size += call[4]
+                retries += call[5]
+        return count, spent, size, retries
+
+    def perfdata(self):
+        nms_calls, nms_time, nms_bytes, nms_retries = self.totals('nms')
+        snmp_calls, snmp_time, snmp_varbinds, snmp_retries = self.totals('snmp')
+        return ["'nms_calls'=%s" % nms_calls, "'nms_time'=%.3fs" % nms_time, "'nms_bytes'=%sB" % nms_bytes,
+                "'nms_retries'=%s" % nms_retries, "'nms_sleep'=%.3fs" % self.totals('sleep')[1],
+                "'snmp_calls'=%s" % snmp_calls, "'snmp_time'=%.3fs" % snmp_time,
+                "'dns_time'=%.3fs" % self.totals('dns')[1], "'run_time'=%.3fs" % (time.time() - self.start)]
+
+    # Append a line per call to the trace file.
+    def write_trace(self, hostname, tracefile):
+        lines = ["# %s run at %s, %s calls\n" % (hostname, time.ctime(self.start), len(self.calls)),
+                 "#  offset kind      time      size retries name\n"]
+        calls = list(self.calls)
+        calls.sort()
+        for offset, kind, name, spent, size, retries in calls:
+            lines.append("%9.3f %-5s %8.3f %9s %7s %s\n" % (offset, kind, spent, size, retries, name))
+        try:
+            trace = open(tracefile, 'a')
+            try:
+                trace.write("".join(lines))
+            finally:
+                trace.close()
+        except IOError:
+            raise CritError("Can not write trace file %s" % tracefile)
+
+
+class SharedRun:
+    # Data fetched by the runs of Nexentas with the same NMS identity, like a VIP and the
+    # node that has it, while those runs overlap. A result is fetched by the first run that
+    # needs it, the others wait for it and use the same result.
+    registry = {}
+    registry_lock = threading.Lock()
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.results = {}
+
+    # Return the result of func for key, calling it only once for all runs sharing this. If
+    # func fails the next run needing the result calls it again.
+    def once(self, key, func):
+        self.lock.acquire()
+        try:
+            entry = self.results.get(key)
+            if not entry:
+                entry = self.results[key] = [threading.Lock(), False, None]
+        finally:
+            self.lock.release()
+
+        entry[0].acquire()
+        try:
+            if not entry[1]:
+                entry[2] = func()
+                entry[1] = True
+            return entry[2]
+        finally:
+            entry[0].release()
+
+
+class FolderCache:
+    # Folder properties read by each check, only these are requested from NMS.
+    check_props = {'-D': ['used', 'available', 'usedbysnapshots'],
+                   '-P': ['used', 'available', 'usedbysnapshots', 'compression', 'compressratio']}
+
+    # Folder names and properties are fetched once per run and shared by -D and -P.
+    # Only folders matching folder_include and not matching folder_exclude are listed.
+    # With <run> set, they are also shared with the runs of other names of the same NMS.
+    # All properties any check reads are requested then, and if api_cache_ttl caches
+    # folder.get_child_props, so runs of -D and -P share the cached results.
+    def __init__(self, hostname, checks, run=None):
+        props = []
+        if run or self.cached(hostname):
+            checks = FolderCache.check_props.keys()
+            checks.sort()
+        for check in checks:
+            for prop in FolderCache.check_props.get(check, []):
+                if prop not in props:
+                    props.append(prop)
+        self.pattern = '^(%s)$' % '|'.join(props)
+        self.shared = len([check for check in checks if check in FolderCache.check_props]) > 1
+        self.run = run
+        self.include = self.compile(hostname, 'folder_include')
+        self.exclude = self.compile(hostname, 'folder_exclude')
+        self.names = None
+        self.props = {}
+        self.read = {}
+        self.saved = 0
+
+    # Return True if api_cache_ttl caches folder.get_child_props.
+    def cached(self, hostname):
+        ttls = ReadConfig().get_option(hostname, 'api_cache_ttl') or ''
+        return 'folder.get_child_props' in [ttl.split(';')[0].strip() for ttl in ttls.split('\n')]
+
+    # Join the regular expressions of a multi-line option into one, or return None if not set.
+    def compile(self, hostname, option):
+        patterns = ReadConfig().get_option(hostname, option)
+        if not patterns:
+            return None
+        patterns = [pattern.strip() for pattern in patterns.split('\n') if pattern.strip()]
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+            except re.error:
+                raise CritError("Error in config file at [%s]:%s, line %s" % (hostname, option, pattern))
+        return re.compile('|'.join(['(?:%s)' % pattern for pattern in patterns]))
+
+    # Return True if a folder is excluded by folder_exclude.
+    def excluded(self, vol):
+        return bool(self.exclude and self.exclude.search(vol))
+
+    # Yield the names of all selected folders as NMS returns them. NMS matches folder_include
+    # itself, the same filter is applied here in case an NMS version ignores the pattern. The
+    # names are only kept when another check of the run reads them too.
+    def get_names(self, api):
+        if self.names is not None:
+            self.saved += 1
+            for vol in self.names:
+                yield vol
+            return
+
+        pattern = ''
+        if self.include:
+            pattern = self.include.pattern
+        if self.run:
+            folders = self.run.once(('folder.get_names', pattern),
+                                    lambda: list(api.iter_data(obj='folder', meth='get_names', par=[pattern])))
+        else:
+            folders = api.iter_data(obj='folder', meth='get_names', par=[pattern])
+        names = []
+        for vol in folders:
+            if (not self.include or self.include.search(vol)) and not self.excluded(vol):
+                if self.shared:
+                    names.append(vol)
+                yield vol
+        if self.shared:
+            self.names = names
+
+    # Return the properties of a folder.
+    def get_props(self, api, vol):
+        if vol in self.read:
+            self.saved += 1
+        elif vol not in self.props:
+            self.props[vol] = self.fetch_props(api, vol)
+        self.read[vol] = True
+        return self.props[vol]
+
+    def fetch_props(self, api, vol):
+        fetch = lambda: api.get_data(obj='folder', meth='get_child_props', par=[vol, self.pattern])
+        if self.run:
+            return self.run.once(('folder.get_child_props', vol, self.pattern), fetch)
+        return fetch()
+
+    # Fetch the properties of all folders not cached yet, <api_concurrency> at a time.
+    def prefetch(self, api, nexenta, volumes):
+        missing = [vol for vol in volumes if vol not in self.props]
+        get_props = lambda vol: self.fetch_props(api, vol)
+        for vol, props in zip(missing, fetch_parallel(nexenta, get_props, missing)):
+            self.props[vol] = props
+
 
 class SnmpRequest:
-    # Read config file and build the NDMP session.
+    # Idle SNMP sessions shared by all SnmpRequest instances, per Nexenta. A session is used
+    # by one request at a time, so stages running at the same time each get their own.
+    sessions = {}
+    sessions_lock = threading.Lock()
+
+    # The SNMPv3 engine ID, boots and time of a Nexenta are read once after a session
+    # discovered them, and kept in state_dir so sessions of later runs skip the discovery.
+    engine_oids = ['SNMP-FRAMEWORK-MIB::snmpEngineID.0', 'SNMP-FRAMEWORK-MIB::snmpEngineBoots.0',
+                   'SNMP-FRAMEWORK-MIB::snmpEngineTime.0']
+
+    # Read config file for the SNMP settings, sessions are opened when first needed.
     def __init__(self, nexenta):
         cfg = ReadConfig()
-        
+        self.stats = nexenta.get('stats')
+
         username = cfg.get_option(nexenta['hostname'], 'snmp_user')
         password = cfg.get_option(nexenta['hostname'], 'snmp_pass')
         community = cfg.get_option(nexenta['hostname'], 'snmp_community')
         port = cfg.get_option(nexenta['hostname'], 'snmp_port')
         if not port:
             port = 161
+        self.bulk_size = cfg.get_option(nexenta['hostname'], 'snmp_bulk_size')
+        if not self.bulk_size:
+            self.bulk_size = 50
+        self.bulk_size = int(self.bulk_size)
+
+        if not (username and password) and not community:
+            raise CritError("Incorrect SNMP info configured for %s" % nexenta['hostname'])
+        self.username = username
+        self.password = password
+        self.community = community
+        self.desthost = '%s:%s' % (nexenta['ip'], port)
+        self.enginefile = os.path.join(state_dir(nexenta), '%s.engine' % nexenta['hostname'])
+
+    # Take an idle session from the pool, or open a new one.
+    def acquire(self):
+        import netsnmp
+        SnmpRequest.sessions_lock.acquire()
+        try:
+            idle = SnmpRequest.sessions.setdefault(self.desthost, [])
+            if idle:
+                return idle.pop()
+        finally:
+            SnmpRequest.sessions_lock.release()
 
         # If username/password use SNMP v3, else use SNMP v2.
-        if username and password:
-            self.session = netsnmp.Session(DestHost='%s:%s' % (nexenta['ip'], port), Version=3, SecLevel='authNoPriv',
-                                           AuthProto='MD5', AuthPass=password, SecName=username)            
-        elif community:
-            self.session = netsnmp.Session(DestHost='%s:%s' % (nexenta['ip'], port), Version=2, Community=community)
-        else:
-             raise CritError("Incorrect SNMP info configured for %s" % nexenta['hostname'])
+        if self.username and self.password:
+            return self.open_v3(self.load_engine())
+        return netsnmp.Session(DestHost=self.desthost, Version=2, Community=self.community)
+
+    # Open a SNMP v3 session, with the engine of the Nexenta if known.
+    def open_v3(self, engine):
+        import netsnmp
+        session = netsnmp.Session(DestHost=self.desthost, Version=3, SecLevel='authNoPriv',
+                                  AuthProto='MD5', AuthPass=self.password, SecName=self.username, **engine)
+        session.cached_engine = bool(engine)
+        session.discovered = not engine
+        return session
+
+    # Return the Session arguments for the engine kept in state_dir, with the engine time
+    # moved on by the time since it was read, or no arguments if not kept.
+    def load_engine(self):
+        try:
+            engineid, boots, enginetime, saved = open_state(self.enginefile).read().split()
+            return {'SecEngineId': engineid, 'EngineBoots': int(boots),
+                    'EngineTime': int(enginetime) + int(time.time() - float(saved))}
+        except (IOError, ValueError):
+            return {}
+
+    # Read the engine of the Nexenta with a session that discovered it, and keep it.
+    def save_engine(self, session):
+        import netsnmp
+        session.discovered = False
+        values = netsnmp.VarList(*[netsnmp.Varbind(oid) for oid in SnmpRequest.engine_oids])
+        session.get(values)
+        engineid, boots, enginetime = [var.val for var in values]
+        if not engineid or not boots or not enginetime:
+            return
+        try:
+            write_file(self.enginefile, '%s %s %s %s' % (engineid.encode('hex'), boots, enginetime, time.time()))
+        except (OSError, IOError):
+            pass
+
+    # Return a session to the pool, it stays open for later requests and runs.
+    def release(self, session):
+        SnmpRequest.sessions_lock.acquire()
+        try:
+            SnmpRequest.sessions[self.desthost].append(session)
+        finally:
+            SnmpRequest.sessions_lock.release()
+
+    # Make a SNMP request on a session of the pool, and record it if the run keeps call stats.
+    # If a session opened with the kept engine gets no answer, the engine may have changed:
+    # the request is made once more on a session that discovers it.
+    def request(self, name, method, *args):
+        session = self.acquire()
+        started = time.time()
+        try:
+            result = getattr(session, method)(*args)
+            if not result and getattr(session, 'cached_engine', False):
+                try:
+                    os.remove(self.enginefile)
+                except OSError:
+                    pass
+                session = self.open_v3({})
+                result = getattr(session, method)(*args)
+            if result and getattr(session, 'discovered', False):
+                self.save_engine(session)
+        finally:
+            self.release(session)
+        if self.stats:
+            self.stats.record('snmp', name, started, len(args[-1]))
+        return result
 
     # Return the SNMP get value.
     def get_snmp(self, oid):
+        import netsnmp
         value = netsnmp.VarList(netsnmp.Varbind(oid))
 
-        if not self.session.get(value):
+        if not self.request(oid, 'get', value):
             return None
         else:
             return value[0].val
 
     # Return the SNMP walk values.
     def walk_snmp(self, oid):
+        import netsnmp
         values = netsnmp.VarList(netsnmp.Varbind(oid))
 
-        if not self.session.walk(values):
+        if not self.request(oid, 'walk', values):
             return None
         else:
             return values
 
+    # Walk several table columns at once with GETBULK, <bulk_size> rows of every column
+    # per request unless size is given, and return the values of each column in walk order.
+    def walk_columns(self, columns, size=None):
+        import netsnmp
+        if not size:
+            size = self.bulk_size
+        values = {}
+        last = {}
+        for column in columns:
+            values[column] = []
+            last[column] = None
+
+        active = list(columns)
+        while active:
+            varlist = netsnmp.VarList()
+            for column in active:
+                if last[column] is None:
+                    varlist.append(netsnmp.Varbind(column))
+                else:
+                    varlist.append(netsnmp.Varbind(column, last[column]))
+
+            if not self.request(" ".join(active), 'getbulk', 0, size, varlist):
+                break
+
+            # Varbinds are returned row by row, a column is done once it walks past its end.
+            done = {}
+            for index in range(len(varlist)):
+                column = active[index % len(active)]
+                var = varlist[index]
+                if column in done:
+                    continue
+                if var.tag != column.split('::')[-1] or var.type == 'ENDOFMIBVIEW':
+                    done[column] = True
+                    continue
+                values[column].append(var)
+
+            # Continue after the last row of each column, stop columns that did not advance.
+            next_active = []
+            for column in active:
+                if column in done or not values[column] or values[column][-1].iid == last[column]:
+                    continue
+                last[column] = values[column][-1].iid
+                next_active.append(column)
+            active = next_active
+
+        return values
+
+    # Return the full output of SNMP extends by name, all read with one request. snmpd runs
+    # the script of every extend read.
+    def get_extends(self, names):
+        import netsnmp
+        values = netsnmp.VarList(*[netsnmp.Varbind('NET-SNMP-EXTEND-MIB::nsExtendOutputFull', '"%s"' % name)
+                                   for name in names])
+
+        if not self.request('nsExtendOutputFull', 'get', values):
+            return {}
+        return dict([(name, var.val) for name, var in zip(names, values) if var.val is not None])
+
+
+class SnmpTables:
+    # Table columns walked by each check.
+    check_columns = {'-E': ['NET-SNMP-EXTEND-MIB::nsExtendOutLine'],
+                     '-P': ['HOST-RESOURCES-MIB::hrSystemUptime', 'HOST-RESOURCES-MIB::hrProcessorLoad',
+                            'IF-MIB::ifName', 'IF-MIB::ifHCInOctets', 'IF-MIB::ifHCOutOctets']}
+
+    # The columns of all SNMP checks of a run are walked at once, by the first check that
+    # needs them, so every GETBULK request advances all of them on one session. -E only
+    # adds its column if snmp_extend is set and extend_ttl is not, extends are read by
+    # ExtendCache then.
+    def __init__(self, hostname, checks):
+        cfg = ReadConfig()
+        self.columns = []
+        for check in checks:
+            if check == "-E" and (cfg.get_option(hostname, 'snmp_extend') != "ON" or
+                                  cfg.get_option(hostname, 'extend_ttl')):
+                continue
+            for column in SnmpTables.check_columns.get(check, []):
+                if column not in self.columns:
+                    self.columns.append(column)
+        self.values = None
+        self.time = None
+
+    # Return the values of every column in walk order, and keep the time they were read.
+    def walk(self, snmp):
+        if self.values is None:
+            self.values = snmp.walk_columns(self.columns)
+            self.time = time.time()
+        return self.values
+
+
+class ExtendCache:
+    # Output of SNMP extends kept in state_dir for extend_ttl seconds per extend, as reading
+    # an extend makes snmpd run its script, which can take seconds. Extends older than their
+    # TTL are served from the cache while a process started in the background reads them
+    # again, up to their max age, 5 times the TTL unless configured. Extends without a TTL,
+    # not read before, or older than their max age are read during the run. A refresh that
+    # fails is kept with the extend, for the next run to report.
+    def __init__(self, nexenta):
+        cfg = ReadConfig()
+        self.hostname = nexenta['hostname']
+        self.path = os.path.join(state_dir(nexenta), '%s.extends' % nexenta['hostname'])
+        self.ttls = {}
+        self.max_ages = {}
+        ttls = cfg.get_option(nexenta['hostname'], 'extend_ttl')
+        if ttls:
+            for ttl in ttls.split('\n'):
+                if not ttl:
+                    continue
+                try:
+                    fields = ttl.split(';')
+                    if len(fields) == 2:
+                        fields.append(int(fields[1]) * 5)
+                    name, seconds, max_age = fields
+                    self.ttls[name.strip()] = int(seconds)
+                    self.max_ages[name.strip()] = int(max_age)
+                except ValueError:
+                    raise CritError("Error in config file at [%s]:extend_ttl, line %s" % (nexenta['hostname'], ttl))
+
+    # Return the names of the extends. The config table does not run the scripts, but the
+    # output tables follow its last 7 columns, so GETBULK may not ask for more than 8 rows
+    # of nsExtendCommand at a time to stay out of them.
+    def names(self, snmp):
+        column = 'NET-SNMP-EXTEND-MIB::nsExtendCommand'
+        return [var.iid.strip('"') for var in snmp.walk_columns([column], 8)[column]]
+
+    # Return the TTL configured for an extend, or the DEFAULT TTL, or None if not cached.
+    def ttl(self, name):
+        return self.ttls.get(name, self.ttls.get('DEFAULT'))
+
+    # Return the age up to which the cached output of an extend is served.
+    def max_age(self, name):
+        return self.max_ages.get(name, self.max_ages.get('DEFAULT'))
+
+    # Lock a file next to the cache. Returns None if flags do not block and it is locked.
+    def lock(self, suffix, flags=fcntl.LOCK_EX):
+        make_state_dir(os.path.dirname(self.path))
+        lockfile = open(self.path + suffix, 'a')
+        try:
+            fcntl.flock(lockfile, flags)
+        except IOError:
+            lockfile.close()
+            return None
+        return lockfile
+
+    def unlock(self, lockfile):
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+
+    def load(self):
+        try:
+            cachefile = open_state(self.path)
+            try:
+                return import_json().load(cachefile)
+            finally:
+                cachefile.close()
+        except (IOError, ValueError):
+            return {}
+
+    # Save the output of extends read at <when>, with the extends other runs cached. Errors
+    # are kept with the output cached before, until the extend is read again.
+    def save(self, outputs, when, errors=None):
+        if not outputs and not errors:
+            return
+        try:
+            lockfile = self.lock('.lock')
+            try:
+                extends = self.load()
+                for name, output in outputs.items():
+                    extends[name] = {'time': when, 'output': output}
+                for name, error in (errors or {}).items():
+                    if name in extends:
+                        extends[name]['error'] = error
+                        extends[name]['failed'] = when
+                write_file(self.path, import_json().dumps(extends))
+            finally:
+                self.unlock(lockfile)
+        except (OSError, IOError):
+            pass
+
+    # Return (name, output, age, error) for every extend, in the order of names. The age is
+    # the number of seconds since the output was read, or None for extends without a TTL.
+    # The error is (seconds ago, message) of the last refresh if it failed, or None. Output
+    # is None for extends that could not be read.
+    def collect(self, snmp, names):
+        now = time.time()
+        cached = self.load()
+        outputs = {}
+        ages = {}
+        errors = {}
+        fetch = []
+        stale = []
+        for name in names:
+            entry = cached.get(name)
+            if self.ttl(name) is None or not entry or now - entry['time'] >= self.max_age(name):
+                fetch.append(name)
+                continue
+            outputs[name] = entry['output'].encode('utf-8')
+            ages[name] = max(now - entry['time'], 0)
+            if ages[name] >= self.ttl(name):
+                stale.append(name)
+            if entry.get('error'):
+                errors[name] = (max(now - entry['failed'], 0), entry['error'].encode('utf-8'))
+
+        if fetch:
+            fetched = snmp.get_extends(fetch)
+            outputs.update(fetched)
+            self.save(dict([(name, output) for name, output in fetched.items() if self.ttl(name) is not None]), now)
+            for name in fetched:
+                if self.ttl(name) is not None:
+                    ages[name] = 0
+        if stale:
+            self.refresh(stale)
+        return [(name, outputs.get(name), ages.get(name), errors.get(name)) for name in names]
+
+    # Start this script in the background to read stale extends, unless a refresh of this
+    # Nexenta is still running. It does not share the output of this run, so Nagios does
+    # not wait for it.
+    def refresh(self, names):
+        import subprocess
+        try:
+            lockfile = self.lock('.refresh', fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (OSError, IOError):
+            return
+        if not lockfile:
+            return
+        self.unlock(lockfile)
+
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        devnull = open(os.devnull, 'r+')
+        try:
+            try:
+                subprocess.Popen([sys.executable, script, '-f', ReadConfig.configfile, '-H', self.hostname,
+                                  '--refresh-extends=%s' % ','.join(names)],
+                                 stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+            except OSError:
+                pass
+        finally:
+            devnull.close()
+
+
+class FaultDigest:
+    # Faults of the triggers of a Nexenta kept in state_dir between runs, with the state and
+    # fault count the trigger had when they were fetched and their known_errors severity and
+    # description. They are used again while the state and fault count of the trigger stay
+    # the same, for at most <ttl> seconds. Faults are classified again without fetching them
+    # if the config file or this script changed.
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.stamp = list(ReadConfig.key)
+        self.triggers = self.load()
+
+    def load(self):
+        try:
+            digestfile = open_state(self.path)
+            try:
+                return import_json().load(digestfile)
+            finally:
+                digestfile.close()
+        except (IOError, ValueError):
+            return {}
+
+    # Return [state, fault count] from the status of a trigger, like "state: ready; faults:
+    # 2; time started: 10:00:00", or None if the status does not have them.
+    def signature(self, status):
+        state = re.search(r'state:\s*([^;]*)', status or '')
+        count = re.search(r'faults:\s*(\d+)', status or '')
+        if not state or not count:
+            return None
+        return [state.group(1).strip(), int(count.group(1))]
+
+    # Return the classified faults of a trigger if its signature did not change, or None.
+    def get(self, trigger, signature):
+        entry = self.triggers.get(trigger)
+        if not signature or not entry or entry['signature'] != signature or entry['time'] + self.ttl < time.time():
+            return None
+        if entry['stamp'] != self.stamp:
+            entry['results'] = [known_errors(fault) for fault in entry['faults']]
+            entry['stamp'] = self.stamp
+        return [tuple(result) for result in entry['results']]
+
+    def put(self, trigger, signature, faults, results):
+        self.triggers[trigger] = {'signature': signature, 'time': time.time(), 'stamp': self.stamp,
+                                  'faults': faults, 'results': results}
+
+    # Save the digest of the given triggers, triggers without faults are not kept. A failure
+    # only means faults are fetched again.
+    def save(self, triggers):
+        digest = {}
+        for trigger in triggers:
+            if trigger in self.triggers:
+                digest[trigger] = self.triggers[trigger]
+        try:
+            write_file(self.path, import_json().dumps(digest))
+        except (OSError, IOError):
+            pass
+
+
+# Return the directory for files kept between runs if state_dir is not set, one per user in
+# the temp directory. Looks up the temp directory like tempfile.gettempdir(), without
+# importing tempfile on every run.
+def default_state_dir():
+    for name in ('TMPDIR', 'TEMP', 'TMP'):
+        if os.environ.get(name):
+            return os.path.join(os.environ[name], 'check_nexenta-%s' % os.getuid())
+    return os.path.join('/tmp', 'check_nexenta-%s' % os.getuid())
+
+
+# Return True if a file kept between runs can be trusted: it is owned by this user and no
+# other user can write it. Files in state_dir decide where credentials are sent.
+def trusted(stat):
+    return stat.st_uid == os.getuid() and not stat.st_mode & 022
+
+
+# Create a directory for files kept between runs, only accessible by this user. A directory
+# another user could write is refused with OSError.
+def make_state_dir(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0700)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    if not trusted(os.stat(directory)):
+        raise OSError("%s is not owned by this user or writable by others" % directory)
+
+
+# Open a file kept between runs for reading. A file, or a directory holding it, another user
+# could write is refused with IOError.
+def open_state(path):
+    statefile = open(path)
+    try:
+        if trusted(os.fstat(statefile.fileno())) and trusted(os.stat(os.path.dirname(path))):
+            return statefile
+    except OSError:
+        pass
+    statefile.close()
+    raise IOError("%s is not owned by this user or writable by others" % path)
+
+
+# Return the directory for files kept between runs.
+def state_dir(nexenta):
+    cfg = ReadConfig()
+    directory = cfg.get_option(nexenta['hostname'], 'state_dir')
+    if not directory:
+        directory = default_state_dir()
+    return directory
+
+
+# Write a file kept between runs through a temporary file, so readers never see a partial
+# file. The directory is created if needed.
+def write_file(path, data):
+    import tempfile
+    directory = os.path.dirname(path)
+    make_state_dir(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+    except (OSError, IOError):
+        os.remove(tmp)
+        raise
+
+
+# Call func for every item using at most <api_concurrency> threads and return the results
+# in the order of items. Stop all work once the check deadline has been reached.
+def fetch_parallel(nexenta, func, items):
+    import Queue
+    cfg = ReadConfig()
+    workers = cfg.get_option(nexenta['hostname'], 'api_concurrency')
+    if not workers:
+        workers = 4
+
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for index in range(len(items)):
+        pending.put(index)
+    errors = []
+
+    def worker():
+        while not errors and time.time() < nexenta['deadline']:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(items[index])
+            except:
+                errors.append(sys.exc_info())
+
+    threads = []
+    for i in range(min(int(workers), len(items))):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join(max(nexenta['deadline'] - time.time(), 0))
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    unfinished = pending.qsize() + len([thread for thread in threads if thread.isAlive()])
+    if unfinished:
+        raise UnknownError("Check deadline reached, %s of %s API calls not done" % (unfinished, len(items)))
+    return results
+
 
 # Convert human readable to real numbers.
 def convert_space(size):
@@ -242,41 +2119,38 @@ def convert_space(size):
         return 0
 
 
+# Format a rate in bit/s to human readable.
+def format_rate(rate):
+    for unit, size in (("Gbit/s", 1e9), ("Mbit/s", 1e6), ("Kbit/s", 1e3)):
+        if rate >= size:
+            return "%.1f%s" % (rate / size, unit)
+    return "%dbit/s" % rate
+
+
+# Format a threshold for performance data, empty if not set.
+def format_limit(limit):
+    if limit is None:
+        return ""
+    return "%d" % limit
+
+
 # Convert severity/description for known errors defined in config file.
 def known_errors(result):
     cfg = ReadConfig()
-    severity = []
-    description = []
-    
+    known = cfg.known_errors()
+
     # Check if part of the message matches a string in the config file.
-    known_error = cfg.known_errors(result['description'])
-    if known_error:
-        # Match found, return severity/description.
-        try:
-            severity, description = known_error.split(';')
-        except ValueError:
-            raise CritError("Error in config file at [known_errors], line: %s" % known_error)
-        
-        if not severity.upper() in ("DEFAULT", "WARNING", "CRITICAL", "UNKNOWN", "IGNORE"):
-            raise CritError("Invalid severity in config file at [known_errors], line: %s" % known_error)
+    severity, description = known.match(result['description'])
 
     if not description:
         # No match found or only severity match found, append default if defined in the config file.
-        default = cfg.get_option('known_errors', "DEFAULT")
-        if default:
-            # Get the default description and append it
-            try:
-                description = default.split(';')[1]
-            except ValueError:
-                raise CritError("Error in config file at [known_errors], line: %s" % default)
-            description = "%s %s" % (result['description'], description)
-            
+        if known.default:
+            default_severity, default_description = known.get(known.default)
+            description = "%s %s" % (result['description'], default_description)
+
             # Get the default severity if there was no match in the config file
             if not severity:
-                try:
-                    severity = default.split(';')[0]
-                except ValueError:
-                    raise CritError("Error in config file at [known_errors], line: %s" % default)
+                severity = default_severity
         else:
             # No default found, pass the original description
             description = result['description']
@@ -293,101 +2167,126 @@ def check_spaceusage(nexenta):
     cfg = ReadConfig()
     errors = []
 
-    # Only check space usage if space thresholds are configured in the config file.
-    thresholds = cfg.get_option(nexenta['hostname'], 'space_threshold')
-    if thresholds:
+    # Only check space usage if space or forecast thresholds are configured in the config file.
+    thresholds = cfg.thresholds('space_threshold', nexenta['hostname'])
+    forecasts = cfg.thresholds('forecast_threshold', nexenta['hostname'])
+    if thresholds or forecasts:
         api = NexentaApi(nexenta)
-        rc = NagiosStates()
-
-        # Get a list of all volumes and add syspool.
-        volumes = api.get_data(obj='folder', meth='get_names', par=[''])
-        volumes.extend(["syspool"])
+        rc = nexenta['rc']
+
+        def checked(vol):
+            return (thresholds and thresholds.lookup(vol)) or (forecasts and forecasts.lookup(vol))
+
+        # Get the selected volumes with a match or a default in thresholds, and add syspool
+        # unless excluded. Fetch the properties of all of them at once, and read them once
+        # for both the forecast and the thresholds.
+        volumes = [vol for vol in nexenta['folders'].get_names(api) if checked(vol)]
+        if not nexenta['folders'].excluded("syspool") and checked("syspool"):
+            volumes.append("syspool")
+        nexenta['folders'].prefetch(api, nexenta, volumes)
+        props = dict([(vol, nexenta['folders'].get_props(api, vol)) for vol in volumes])
+
+        # Add the used space to the usage history, and forecast when the volumes will be full
+        # from the trend of their history, all volumes at once.
+        full = {}
+        if forecasts:
+            samples = []
+            for vol in volumes:
+                if forecasts.lookup(vol):
+                    volprops = props[vol]
+                    samples.append((vol, convert_space(volprops.get('used')), convert_space(volprops.get('available'))))
+
+            days = cfg.get_option(nexenta['hostname'], 'forecast_history')
+            if not days:
+                days = 14
+            history = UsageHistory(os.path.join(state_dir(nexenta), '%s.history' % nexenta['hostname']), float(days))
+            try:
+                full = history.forecast(time.time(), samples)
+            except EnvironmentError, error:
+                rc.RC = NagiosStates.UNKNOWN
+                errors.append("UNKNOWN: Can not keep usage history in %s: %s" % (history.path, error))
 
         for vol in volumes:
-            # Skip this volume if no match and no default in thresholds.
-            if not vol + ";" in thresholds and not "DEFAULT;" in thresholds:
-                continue
-
-            for threshold in thresholds.split('\n'):
-                if not threshold:
-                    continue
-
-                # Check/extend the thresholds.
-                if len(threshold.split(';')) == 3:
-                    threshold += ";IGNORE;IGNORE"
-                elif len(threshold.split(';')) != 5:
-                    raise CritError("Error in config file at [%s]:space_threshold, line %s" % (nexenta['hostname'], threshold))
-
-                # Get the thresholds, or fall back to the default tresholds.
-                if vol + ";" in thresholds:
-                    if threshold.split(';')[0] == vol:
-                        volwarn, volcrit, snapwarn, snapcrit = threshold.split(';')[1:]
-                elif "DEFAULT;" in thresholds:
-                    if threshold.split(';')[0] == "DEFAULT":
-                        volwarn, volcrit, snapwarn, snapcrit = threshold.split(';')[1:]
+            # Get the thresholds, or fall back to the default tresholds.
+            volwarn = volcrit = snapwarn = snapcrit = None
+            if thresholds and thresholds.lookup(vol):
+                volwarn, volcrit, snapwarn, snapcrit = thresholds.lookup(vol)
 
             # Get volume properties.
-            volprops = api.get_data(obj='folder', meth='get_child_props', par=[vol, ''])
+            volprops = props[vol]
 
             # Get used/available space.
             available = volprops.get('available')
             snapused = volprops.get('usedbysnapshots')
             volused = convert_space(volprops.get('used'))
+            volavailable = convert_space(available)
+            snapusedbytes = convert_space(snapused)
 
-            snapusedprc = (convert_space(snapused) / (volused + convert_space(available))) * 100
-            volusedprc = (volused / (volused + convert_space(available))) * 100
+            snapusedprc = (snapusedbytes / (volused + volavailable)) * 100
+            volusedprc = (volused / (volused + volavailable)) * 100
 
             # Check if a snapshot threshold has been met.
             snaperror = ""
-            if snapwarn[:-1].isdigit():
-                if '%' in snapwarn:
-                    if int(snapwarn[:-1]) <= snapusedprc:
+            if snapwarn:
+                if snapwarn[0] == '%':
+                    if snapwarn[1] <= snapusedprc:
                         rc.RC = NagiosStates.WARNING
                         snaperror = "WARNING: %s%% of %s used by snaphots" % (int(snapusedprc), vol)
-                elif convert_space(snapwarn) <= convert_space(snapused):
-                        rc.RC = NagiosStates.WARNING
-                        snaperror = "WARNING: %s of %s used by snaphots" % (snapused, vol)
+                elif snapwarn[1] <= snapusedbytes:
+                    rc.RC = NagiosStates.WARNING
+                    snaperror = "WARNING: %s of %s used by snaphots" % (snapused, vol)
 
-            if snapcrit[:-1].isdigit():
-                if '%' in snapcrit:
-                    if int(snapcrit[:-1]) <= snapusedprc:
+            if snapcrit:
+                if snapcrit[0] == '%':
+                    if snapcrit[1] <= snapusedprc:
                         rc.RC = NagiosStates.CRITICAL
                         snaperror = "CRITICAL: %s%% of %s used by snaphots" % (int(snapusedprc), vol)
-                elif convert_space(snapcrit) <= convert_space(snapused):
-                        rc.RC = NagiosStates.CRITICAL
-                        snaperror = "CRITICAL: %s of %s used by snaphots" % (snapused, vol)
+                elif snapcrit[1] <= snapusedbytes:
+                    rc.RC = NagiosStates.CRITICAL
+                    snaperror = "CRITICAL: %s of %s used by snaphots" % (snapused, vol)
 
             if snaperror:
                 errors.append(snaperror)
 
             # Check if a folder threshold has been met.
-            if volcrit[:-1].isdigit():
-                if '%' in volcrit:
-                    if int(volcrit[:-1]) <= volusedprc:
+            if volcrit:
+                if volcrit[0] == '%':
+                    if volcrit[1] <= volusedprc:
                         rc.RC = NagiosStates.CRITICAL
                         errors.append("CRITICAL: %s %s%% full!" % (vol, int(volusedprc)))
                         continue
-                elif convert_space(volcrit) >= convert_space(available):
+                elif volcrit[1] >= volavailable:
                     rc.RC = NagiosStates.CRITICAL
                     errors.append("CRITICAL: %s %s available!" % (vol, available))
                     continue
 
-            if volwarn[:-1].isdigit():
-                if '%' in volwarn:
-                    if int(volwarn[:-1]) <= volusedprc:
+            if volwarn:
+                if volwarn[0] == '%':
+                    if volwarn[1] <= volusedprc:
                         rc.RC = NagiosStates.WARNING
                         errors.append("WARNING: %s %s%% full" % (vol, int(volusedprc)))
-                elif convert_space(volwarn) >= convert_space(available):
+                elif volwarn[1] >= volavailable:
                     rc.RC = NagiosStates.WARNING
                     errors.append("WARNING: %s %s available" % (vol, available))
 
-    return (errors)
+            # Check if the volume is forecast to be full within a threshold.
+            if vol in full:
+                fullwarn, fullcrit = forecasts.lookup(vol)
+                fulldays = full[vol] / 86400
+                if fullcrit is not None and fulldays <= fullcrit:
+                    rc.RC = NagiosStates.CRITICAL
+                    errors.append("CRITICAL: %s full in %.1f days!" % (vol, fulldays))
+                elif fullwarn is not None and fulldays <= fullwarn:
+                    rc.RC = NagiosStates.WARNING
+                    errors.append("WARNING: %s full in %.1f days" % (vol, fulldays))
+
+    return (errors, [])
 
 
 # Check Nexenta runners for faults.
 def check_triggers(nexenta):
     cfg = ReadConfig()
-    rc = NagiosStates()
+    rc = nexenta['rc']
     errors = []
 
     # Check all triggers, if skip_triggers is not set to 'on' in the config file.
@@ -395,14 +2294,49 @@ def check_triggers(nexenta):
     if skip != "ON":
         api = NexentaApi(nexenta)
 
-        triggers = api.get_data(obj='reporter', meth='get_names_by_prop', par=['type', 'trigger', ''])
-        for trigger in triggers:
-            results = api.get_data(obj='trigger', meth='get_faults', par=[trigger])
-            for result in results:
-                result = results[result]
+        # Get the faults of all triggers at once, converting severity/description while they
+        # are read, and handle them in trigger order. Runs of other names of the same NMS
+        # use the faults fetched by the first of them.
+        def get_faults(trigger):
+            faults = api.iter_data(obj='trigger', meth='get_faults', par=[trigger])
+            return [known_errors(result) for fault, result in faults]
+
+        # With fault_digest_ttl set, triggers with 0 faults in their status are listed with
+        # one call and not asked for faults. Of the others only the status is read, their
+        # faults are fetched if it changed since the faults kept in the digest.
+        ttl = cfg.get_option(nexenta['hostname'], 'fault_digest_ttl')
+        if ttl:
+            digest = FaultDigest(os.path.join(state_dir(nexenta), '%s.faults' % nexenta['hostname']), int(ttl))
+
+        def get_digested(trigger):
+            status = api.get_data(obj='reporter', meth='get_child_props', par=[trigger, '^status$'])
+            signature = digest.signature((status or {}).get('status'))
+            results = digest.get(trigger, signature)
+            if results is None:
+                faults = [{'description': result['description'], 'severity': result['severity']}
+                          for fault, result in api.iter_data(obj='trigger', meth='get_faults', par=[trigger])]
+                results = [known_errors(fault) for fault in faults]
+                digest.put(trigger, signature, faults, results)
+            return results
+
+        def get_triggers():
+            triggers = api.get_data(obj='reporter', meth='get_names_by_prop', par=['type', 'trigger', ''])
+            if not ttl:
+                return zip(triggers, fetch_parallel(nexenta, get_faults, triggers))
+
+            healthy = set(api.get_data(obj='reporter', meth='get_names_by_prop', par=['status', 'faults: 0;', '']) or [])
+            faulted = [trigger for trigger in triggers if trigger not in healthy]
+            faults = dict(zip(faulted, fetch_parallel(nexenta, get_digested, faulted)))
+            digest.save(faulted)
+            return [(trigger, faults.get(trigger, [])) for trigger in triggers]
+
+        if 'shared' in nexenta:
+            triggers = nexenta['shared'].once(('trigger.get_faults',), get_triggers)
+        else:
+            triggers = get_triggers()
 
-                # Convert severity/description.
-                severity, description = known_errors(result)
+        for trigger, results in triggers:
+            for severity, description in results:
                 # Only append if severity is not 'IGNORE'
                 if not severity == "IGNORE":
                     if severity == "CRITICAL":
@@ -414,13 +2348,13 @@ def check_triggers(nexenta):
                     
                     errors.append("%s:%s: %s" % (trigger, severity, description))
 
-    return (errors)
+    return (errors, [])
 
 
 # Get snmp extend data and write to Output and/or Perfdata.
 def collect_extends(nexenta):
     cfg = ReadConfig()
-    rc = NagiosStates()
+    rc = nexenta['rc']
     output = []
     perfdata = []
 
@@ -429,34 +2363,80 @@ def collect_extends(nexenta):
     if extend == "ON":
         # Check for dependancy net-snmp-python.
         try:
-            netsnmp
-        except NameError:
+            import netsnmp
+        except ImportError:
             rc.RC = NagiosStates.WARNING
-            return ("WARNING: net-snmp-python not available, SNMP Extend Data will be skipped.", "")
+            return (["WARNING: net-snmp-python not available, SNMP Extend Data will be skipped."], [])
         else:
             snmp = SnmpRequest(nexenta)
 
-        # Snmp walk through all extends and collect the data.
-        extends = snmp.walk_snmp('NET-SNMP-EXTEND-MIB::nsExtendOutLine')
-        if extends:
-            for data in extends:
-                if "PERFDATA:" in data.val:
-                    perfdata.append(data.val.split("PERFDATA:")[1])
-                elif "OUTPUT:" in data.val:
-                    output.append(data.val.split("OUTPUT:")[1])
+        # Snmp walk through all extends and collect the data, or read them through the extend
+        # cache if extend_ttl is set. Cached output is reported with its age.
+        cache = ExtendCache(nexenta)
+        if cache.ttls:
+            extends = cache.collect(snmp, cache.names(snmp))
+        else:
+            lines = [var.val for var in nexenta['snmp'].walk(snmp)['NET-SNMP-EXTEND-MIB::nsExtendOutLine']]
+            extends = [(None, "\n".join(lines), None, None)]
+
+        for name, lines, age, error in extends:
+            if error:
+                rc.RC = NagiosStates.UNKNOWN
+                output.append("UNKNOWN: Refreshing extend %s failed %ss ago: %s" % (name, int(error[0]), error[1]))
+            if lines is None:
+                rc.RC = NagiosStates.UNKNOWN
+                output.append("UNKNOWN: Can not read extend %s" % name)
+                continue
+            for line in lines.split('\n'):
+                if "PERFDATA:" in line:
+                    perfdata.append(line.split("PERFDATA:")[1])
+                elif "OUTPUT:" in line:
+                    if age is None:
+                        output.append(line.split("OUTPUT:")[1])
+                    else:
+                        output.append("%s (%ss old)" % (line.split("OUTPUT:")[1], int(age)))
 
-                    if "CRITICAL" in data.val:
+                    if "CRITICAL" in line:
                         rc.RC = NagiosStates.CRITICAL
-                    elif "WARNING" in data.val:
+                    elif "WARNING" in line:
                         rc.RC = NagiosStates.WARNING
+            if age is not None:
+                perfdata.append("'%s age'=%ss" % (name, int(age)))
 
     return (output, perfdata)
 
 
-# Collect Nexenta performance data.
-def collect_perfdata(nexenta):
+# Read stale SNMP extends into the extend cache. Only one refresh runs per Nexenta at a time,
+# a refresh started while another runs does nothing. Nobody sees the output of this process,
+# so extends it can not read are saved with the error for the next run to report.
+def refresh_extends(host, names):
+    nexenta = dict(host)
+    cache = ExtendCache(nexenta)
+    lockfile = cache.lock('.refresh', fcntl.LOCK_EX | fcntl.LOCK_NB)
+    if not lockfile:
+        return (NagiosStates.OK, "Extends of %s are being refreshed" % nexenta['hostname'])
+    try:
+        started = time.time()
+        error = "No output from snmpd"
+        try:
+            outputs = SnmpRequest(nexenta).get_extends(names)
+        except Exception, exception:
+            outputs = {}
+            error = str(exception) or exception.__class__.__name__
+        failed = dict([(name, error) for name in names if name not in outputs])
+        cache.save(outputs, started, failed)
+    finally:
+        cache.unlock(lockfile)
+    if failed:
+        return (NagiosStates.UNKNOWN, "Can not refresh extends of %s: %s: %s" %
+                (nexenta['hostname'], ", ".join(sorted(failed)), error))
+    return (NagiosStates.OK, "Refreshed extends of %s: %s" % (nexenta['hostname'], ", ".join(sorted(outputs))))
+
+
+# Collect Nexenta SNMP performance data.
+def collect_snmp_perfdata(nexenta):
     cfg = ReadConfig()
-    rc = NagiosStates()
+    rc = nexenta['rc']
     perfdata = []
     output = []
 
@@ -464,30 +2444,83 @@ def collect_perfdata(nexenta):
     if cfg.get_option(nexenta['hostname'], 'snmp_user') or cfg.get_option(nexenta['hostname'], 'snmp_community'):
         # Check for dependancy net-snmp-python.
         try:
-            netsnmp
-        except NameError:
+            import netsnmp
+        except ImportError:
             rc.RC = NagiosStates.WARNING
             output.append("WARNING: net-snmp-python not available, SNMP Performance Data will be skipped.")
         else:
             snmp = SnmpRequest(nexenta)
 
-            # Get CPU usage.
-            cpu_info = snmp.walk_snmp('HOST-RESOURCES-MIB::hrProcessorLoad')
-            if cpu_info:
-                for cpu_id, cpu_load in enumerate(cpu_info):
-                    perfdata.append("'CPU%s used'=%s%%" % (cpu_id, cpu_load.val))
+            # Get uptime, CPU usage and network traffic in one table walk, with the extends if
+            # -E is run too.
+            columns = nexenta['snmp'].walk(snmp)
+            now = nexenta['snmp'].time
 
-            # Get Network Traffic.
-            interfaces = snmp.walk_snmp('IF-MIB::ifName')
-            if interfaces:
-                for interface in interfaces:
-                    intraffic = snmp.get_snmp('IF-MIB::ifHCInOctets.%s' % interface.iid)
-                    outtraffic = snmp.get_snmp('IF-MIB::ifHCOutOctets.%s' % interface.iid)
-                    intraffic = int(intraffic) * 8
-                    outtraffic = int(outtraffic) * 8
+            for cpu_id, cpu_load in enumerate(columns['HOST-RESOURCES-MIB::hrProcessorLoad']):
+                perfdata.append("'CPU%s used'=%s%%" % (cpu_id, cpu_load.val))
 
-                    perfdata.append("'%s Traffic in'=%sc" % (interface.val, intraffic))
-                    perfdata.append("'%s Traffic out'=%sc" % (interface.val, outtraffic))
+            # Join the traffic counters to the interface names by ifIndex.
+            incounters = dict([(var.iid, var.val) for var in columns['IF-MIB::ifHCInOctets']])
+            outcounters = dict([(var.iid, var.val) for var in columns['IF-MIB::ifHCOutOctets']])
+            samples = []
+            for interface in columns['IF-MIB::ifName']:
+                if interface.iid not in incounters or interface.iid not in outcounters:
+                    continue
+                inoctets = int(incounters[interface.iid])
+                outoctets = int(outcounters[interface.iid])
+                samples.append((interface.val, inoctets, outoctets))
+
+                perfdata.append("'%s Traffic in'=%sc" % (interface.val, inoctets * 8))
+                perfdata.append("'%s Traffic out'=%sc" % (interface.val, outoctets * 8))
+
+            # Turn the counters into rates since the previous run. The Nexenta was rebooted
+            # if its boot time, derived from the uptime in hundredths of a second, moved. A
+            # walk that failed leaves the counters of the previous run alone.
+            rates = {}
+            thresholds = cfg.thresholds('traffic_threshold', nexenta['hostname'])
+            store = CounterStore(os.path.join(state_dir(nexenta), '%s.counters' % nexenta['hostname']))
+            try:
+                if samples and columns['HOST-RESOURCES-MIB::hrSystemUptime']:
+                    boot = now - int(columns['HOST-RESOURCES-MIB::hrSystemUptime'][0].val) / 100.0
+                    rates = store.update(boot, now, samples)
+            except EnvironmentError, error:
+                if thresholds:
+                    rc.RC = NagiosStates.UNKNOWN
+                    output.append("UNKNOWN: Can not keep traffic counters in %s: %s" % (store.path, error))
+
+            for interface, inoctets, outoctets in samples:
+                if interface not in rates:
+                    continue
+                limits = None
+                if thresholds:
+                    limits = thresholds.lookup(interface)
+                if not limits:
+                    limits = [None, None, None, None]
+
+                for direction, rate, warn, crit in (('in', rates[interface][0], limits[0], limits[1]),
+                                                    ('out', rates[interface][1], limits[2], limits[3])):
+                    if warn is None and crit is None:
+                        perfdata.append("'%s Traffic %s rate'=%d" % (interface, direction, rate))
+                    else:
+                        perfdata.append("'%s Traffic %s rate'=%d;%s;%s" % (interface, direction, rate,
+                                        format_limit(warn), format_limit(crit)))
+
+                    # Check if a traffic threshold has been met.
+                    if crit is not None and rate >= crit:
+                        rc.RC = NagiosStates.CRITICAL
+                        output.append("CRITICAL: %s traffic %s %s!" % (interface, direction, format_rate(rate)))
+                    elif warn is not None and rate >= warn:
+                        rc.RC = NagiosStates.WARNING
+                        output.append("WARNING: %s traffic %s %s" % (interface, direction, format_rate(rate)))
+
+    return (output, perfdata)
+
+
+# Collect Nexenta API performance data.
+def collect_api_perfdata(nexenta):
+    cfg = ReadConfig()
+    perfdata = []
+    output = []
 
     # Collect API performance data, if api is configured in the config file for this Nexenta.
     if cfg.get_option(nexenta['hostname'], 'api_user') and cfg.get_option(nexenta['hostname'], 'api_pass'):
@@ -497,13 +2530,15 @@ def collect_perfdata(nexenta):
         # Get perfdata for all volumes, or only for syspool if skip_folderperf is set to 'on'.
         skip = cfg.get_option(nexenta['hostname'], 'skip_folderperf')
         if skip != "ON":
-            volumes.extend(api.get_data(obj='folder', meth='get_names', par=['']))
+            volumes.extend(nexenta['folders'].get_names(api))
 
-        volumes.extend(["syspool"])
+        if not nexenta['folders'].excluded("syspool"):
+            volumes.extend(["syspool"])
+        nexenta['folders'].prefetch(api, nexenta, volumes)
 
         for vol in volumes:
             # Get volume properties.
-            volprops = api.get_data(obj='folder', meth='get_child_props', par=[vol, ''])
+            volprops = nexenta['folders'].get_props(api, vol)
 
             # Get volume used, free and snapshot space.
             used = convert_space(volprops.get('used')) / 1024
@@ -532,92 +2567,529 @@ def collect_perfdata(nexenta):
 
 
 
+# Run the stages of a run, every lane in its own thread and the stages of a lane one after
+# the other. Return a result per stage, in the order of stages: ('done', (output, perfdata)),
+# ('error', exc_info) if the stage raised, or None if it did not run before the deadline.
+def run_stages(nexenta, stages):
+    results = [None] * len(stages)
+    lanes = {}
+    order = []
+    for index in range(len(stages)):
+        lane = stages[index][1]
+        if lane not in lanes:
+            lanes[lane] = []
+            order.append(lane)
+        lanes[lane].append(index)
+
+    # A stage hitting the deadline or the open circuit breaker does not stop the next stage
+    # of its lane if there is time left, any other error does.
+    def run_lane(indexes):
+        for index in indexes:
+            try:
+                results[index] = ('done', stages[index][2](nexenta))
+            except UnknownError:
+                results[index] = ('error', sys.exc_info())
+                if time.time() >= nexenta['deadline']:
+                    return
+            except:
+                results[index] = ('error', sys.exc_info())
+                return
+
+    threads = []
+    for lane in order:
+        thread = threading.Thread(target=run_lane, args=(lanes[lane],))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(nexenta['deadline'] - time.time(), 0))
+    return list(results)
+
+
+# Resolve the hostname of a Nexenta once. If dns_cache_ttl is set, the address is kept in
+# state_dir for that many seconds and most runs skip the lookup.
+def resolve(hostname):
+    cfg = ReadConfig()
+    started = time.time()
+    ttl = cfg.get_option(hostname, 'dns_cache_ttl')
+    if ttl:
+        cachefile = os.path.join(state_dir({'hostname': hostname}), '%s.dns' % hostname)
+        try:
+            if time.time() - os.path.getmtime(cachefile) < int(ttl):
+                ip = open_state(cachefile).read().strip()
+                if ip:
+                    return { 'hostname': hostname, 'ip': ip, 'resolved': started }
+        except (OSError, IOError):
+            pass
+
+    import socket
+    try:
+        ip = socket.getaddrinfo(hostname,None)[0][4][0]
+    except socket.gaierror:
+        raise CritError("No IP address found for %s!" % hostname)
+
+    if ttl:
+        try:
+            write_file(cachefile, ip)
+        except (OSError, IOError):
+            pass
+    return { 'hostname': hostname, 'ip': ip, 'resolved': started }
+
+
+# Return the NMS identity of a Nexenta, its hostid. It is kept in state_dir for identity_ttl
+# seconds, as it only changes when a VIP moves to another node. The hostname is used if
+# NMS can not tell, then Nexentas reached by several names do not share data.
+def identify(nexenta, ttl):
+    cfg = ReadConfig()
+    if not cfg.get_option(nexenta['hostname'], 'api_user') or not cfg.get_option(nexenta['hostname'], 'api_pass'):
+        return nexenta['hostname']
+
+    cachefile = os.path.join(state_dir(nexenta), '%s.identity' % nexenta['hostname'])
+    try:
+        if time.time() - os.path.getmtime(cachefile) < ttl:
+            identity = open_state(cachefile).read().strip()
+            if identity:
+                return identity
+    except (OSError, IOError):
+        pass
+
+    try:
+        hostid = NexentaApi(nexenta).get_data(obj='appliance', meth='get_host_id', par=[])
+    except (CritError, UnknownError):
+        return nexenta['hostname']
+    if not hostid:
+        return nexenta['hostname']
+
+    identity = 'hostid:%s' % hostid
+    try:
+        write_file(cachefile, identity)
+    except (OSError, IOError):
+        pass
+    return identity
+
+
+# Return the data shared with other runs for the identity of a run, or start new shared
+# data if no run with that identity is in progress.
+def shared_run(nexenta):
+    SharedRun.registry_lock.acquire()
+    try:
+        shared = SharedRun.registry.get(nexenta['identity'])
+        if not shared or shared.deadline <= time.time():
+            shared = SharedRun(nexenta['deadline'])
+            SharedRun.registry[nexenta['identity']] = shared
+        return shared
+    finally:
+        SharedRun.registry_lock.release()
+
+
+# Run the checks for one Nexenta and return the state and output. All state of the run
+# is kept in the nexenta dict, so runs for several Nexentas can overlap.
+def run_checks(host, checks, options):
+    cfg = ReadConfig()
+    nexenta = dict(host)
+    nexenta['rc'] = NagiosStates()
+    nexenta['stats'] = CallStats()
+    if 'resolved' in host:
+        nexenta['stats'].record('dns', host['hostname'], host.pop('resolved'))
+
+    # Stop all checks when the deadline has been reached, so Nagios does not time out first.
+    timeout = cfg.get_option(nexenta['hostname'], 'check_timeout')
+    if not timeout:
+        timeout = 55
+    nexenta['deadline'] = time.time() + int(timeout)
+
+    # Fail fast while NMS keeps failing, if a circuit breaker is configured.
+    threshold = cfg.get_option(nexenta['hostname'], 'nms_breaker')
+    if threshold:
+        probe = cfg.get_option(nexenta['hostname'], 'nms_breaker_probe')
+        if not probe:
+            probe = 300
+        nexenta['breaker'] = CircuitBreaker(os.path.join(state_dir(nexenta), '%s.breaker' % nexenta['hostname']),
+                                            int(threshold), int(probe))
+
+    # Share folder and trigger data with runs for other names of the same NMS, like a VIP
+    # and the node that has it, if identity_ttl is set.
+    ttl = cfg.get_option(nexenta['hostname'], 'identity_ttl')
+    if ttl:
+        nexenta['identity'] = identify(nexenta, int(ttl))
+        nexenta['shared'] = shared_run(nexenta)
+        nexenta['folders'] = FolderCache(nexenta['hostname'], checks, nexenta['shared'])
+    else:
+        nexenta['folders'] = FolderCache(nexenta['hostname'], checks)
+    nexenta['snmp'] = SnmpTables(nexenta['hostname'], checks)
+
+    # Split the checks into stages that do not depend on each other, like the SNMP and API
+    # parts of -P, and run them at the same time. Stages sharing the folder cache or the SNMP
+    # tables run one after the other in the same lane, so their data is fetched once.
+    stages = []
+    for check in checks:
+        if check == "-D":
+            # Check spage usage.
+            stages.append((check, 'folders', check_spaceusage))
+        elif check == "-T":
+            # Check fault triggers.
+            stages.append((check, 'triggers', check_triggers))
+        elif check == "-E":
+            # Run SNMP extend scripts and collect output/performance data.
+            stages.append((check, 'snmp', collect_extends))
+        elif check == "-P":
+            # Collect performance data.
+            stages.append((check, 'snmp', collect_snmp_perfdata))
+            stages.append((check, 'folders', collect_api_perfdata))
+
+    # Gather the results in the order of the checks.
+    output = []
+    perfdata = []
+    for stage, result in zip(stages, run_stages(nexenta, stages)):
+        if not result:
+            error = "Check deadline reached before %s finished" % stage[0]
+        elif result[0] == 'error' and issubclass(result[1][0], UnknownError):
+            error = result[1][1]
+        elif result[0] == 'error':
+            raise result[1][0], result[1][1], result[1][2]
+        else:
+            out, perf = result[1]
+            if out:
+                output.extend(out)
+            if perf:
+                perfdata.extend(perf)
+            continue
+
+        # Deadline reached or circuit breaker open, return UNKNOWN with the results
+        # collected so far.
+        nexenta['rc'].RC = NagiosStates.UNKNOWN
+        if not "UNKNOWN: %s" % error in output:
+            output.append("UNKNOWN: %s" % error)
+
+    if nexenta['rc'].RC == NagiosStates.OK:
+        output.append("Nexenta check OK")
+
+    # Report the circuit breaker state, unless the UNKNOWN of the open breaker already did.
+    if 'breaker' in nexenta:
+        if not nexenta['breaker'].tripped:
+            output.append(nexenta['breaker'].status())
+        if nexenta['breaker'].is_open():
+            perfdata.append("'nms_breaker'=1")
+        else:
+            perfdata.append("'nms_breaker'=0")
+
+    # Report the API calls saved by sharing folder data between checks.
+    if nexenta['folders'].saved:
+        output.append("Folder cache saved %s API calls" % nexenta['folders'].saved)
+
+    # Report the time spent in API, SNMP and DNS calls, and write the trace if requested.
+    if options.get('stats'):
+        perfdata.extend(nexenta['stats'].perfdata())
+    if options.get('trace'):
+        nexenta['stats'].write_trace(nexenta['hostname'], options['trace'])
+
+    # Append performance data if collected.
+    if perfdata:
+        return nexenta['rc'].RC, "%s|%s" % ("<br>".join(output), " ".join(perfdata))
+    else:
+        return nexenta['rc'].RC, "<br>".join(output)
+
+
+# Run the checks, and return the state and output instead of raising CritError/UnknownError.
+def run_service(host, checks, options):
+    try:
+        return run_checks(host, checks, options)
+    except (CritError, UnknownError), error:
+        return error.state, "%s: %s" % (error.label, error)
+
+
+# Check several Nexentas at the same time, and return the combined state and a result
+# line per Nexenta in the given order.
+def run_batch(hostnames, checks, options):
+    results = {}
+
+    def check_host(hostname):
+        try:
+            results[hostname] = run_service(resolve(hostname), checks, options)
+        except CritError, error:
+            results[hostname] = error.state, "%s: %s" % (error.label, error)
+
+    threads = []
+    for hostname in hostnames:
+        thread = threading.Thread(target=check_host, args=(hostname,))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    # Nagios reads everything after the first | of the long output as performance data, so
+    # the performance data of all Nexentas follows their lines, labels prefixed by hostname.
+    rc = NagiosStates()
+    counts = {}
+    lines = []
+    perfdata = []
+    for hostname in hostnames:
+        state, output = results[hostname]
+        rc.RC = state
+        counts[state] = counts.get(state, 0) + 1
+        if '|' in output:
+            output, data = output.split('|', 1)
+            perfdata.append(prefix_perfdata(hostname, data.strip()))
+        lines.append("%s: %s" % (hostname, output))
+
+    summary = []
+    for state, label in ((NagiosStates.CRITICAL, "CRITICAL"), (NagiosStates.WARNING, "WARNING"),
+                         (NagiosStates.UNKNOWN, "UNKNOWN"), (NagiosStates.OK, "OK")):
+        if counts.get(state):
+            summary.append("%s %s" % (counts[state], label))
+    lines.insert(0, "Checked %s Nexentas: %s" % (len(hostnames), ", ".join(summary)))
+    if perfdata:
+        lines[-1] = "%s|%s" % (lines[-1], " ".join(perfdata))
+    return rc.RC, "\n".join(lines)
+
+
+# Prefix the labels of performance data with a hostname, e.g. 'CPU0 used'=5% becomes
+# 'nexenta1 CPU0 used'=5%.
+def prefix_perfdata(hostname, perfdata):
+    label = re.compile(r"(^|\s)(?:'([^']*)'|([^\s'=]+))=")
+    return label.sub(lambda match: "%s'%s %s'=" % (match.group(1), hostname, match.group(2) or match.group(3)),
+                     perfdata)
+
+
+# Submit passive check results to the Nagios command file and/or NSCA.
+def submit_results(results):
+    cfg = ReadConfig()
+    command_file = cfg.get_option('daemon', 'command_file')
+    send_nsca = cfg.get_option('daemon', 'send_nsca')
+
+    if command_file:
+        now = int(time.time())
+        lines = []
+        for hostname, service, state, output in results:
+            lines.append("[%s] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%s;%s\n" % (now, hostname, service, state, output))
+        try:
+            cmd = open(command_file, 'a')
+            try:
+                cmd.write("".join(lines))
+            finally:
+                cmd.close()
+        except IOError, error:
+            sys.stderr.write("Can not write to command file %s: %s\n" % (command_file, error))
+
+    if send_nsca:
+        import subprocess
+        args = [send_nsca, '-H', cfg.get_option('daemon', 'nsca_host')]
+        if cfg.get_option('daemon', 'nsca_config'):
+            args.extend(['-c', cfg.get_option('daemon', 'nsca_config')])
+        lines = []
+        for hostname, service, state, output in results:
+            lines.append("%s\t%s\t%s\t%s\n" % (hostname, service, state, output))
+        try:
+            nsca = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            nsca.communicate("".join(lines))
+        except OSError, error:
+            sys.stderr.write("Can not run %s: %s\n" % (send_nsca, error))
+
+
+# Keep running the configured services for all Nexentas every <interval> seconds and
+# submit the results as passive checks. Every Nexenta is checked in its own thread, the
+# API connections and SNMP sessions stay open between runs.
+def run_daemon():
+    cfg = ReadConfig()
+    if not cfg.has_section('daemon'):
+        raise CritError("daemon not defined in config file!")
+    if not cfg.get_option('daemon', 'command_file') and not cfg.get_option('daemon', 'send_nsca'):
+        raise CritError("No command_file or send_nsca configured at [daemon]")
+
+    interval = cfg.get_option('daemon', 'interval')
+    if not interval:
+        interval = 300
+
+    # Get the Nexentas to check, or check all configured Nexentas.
+    hostnames = cfg.get_option('daemon', 'hosts')
+    if hostnames:
+        hostnames = hostnames.split()
+    else:
+        hostnames = cfg.hostnames()
+
+    # Get the services to run, formatted as <service description>;<checks>.
+    services = []
+    for service in (cfg.get_option('daemon', 'services') or "Nexenta;DT").split('\n'):
+        if not service:
+            continue
+        try:
+            description, checks = service.split(';')
+        except ValueError:
+            raise CritError("Error in config file at [daemon]:services, line %s" % service)
+        services.append((description, ["-%s" % check for check in checks.upper()]))
+
+    # Every run of a Nexenta adds its results to a list of its own. A run still going after
+    # the interval is not started again, its results are submitted once it is done. The
+    # address is resolved for every run, dns_cache_ttl keeps it between runs if set.
+    def check_host(hostname, results):
+        try:
+            host = resolve(hostname)
+        except CritError, error:
+            for description, checks in services:
+                results.append((hostname, description, CritError.state, "%s: %s" % (error.label, error)))
+            return
+        for description, checks in services:
+            state, output = run_service(host, checks, {})
+            results.append((hostname, description, state, output))
+
+    running = {}
+    while True:
+        start = time.time()
+        for hostname in hostnames:
+            if hostname in running:
+                continue
+            results = []
+            thread = threading.Thread(target=check_host, args=(hostname, results))
+            thread.setDaemon(True)
+            thread.start()
+            running[hostname] = (thread, results)
+        for thread, results in running.values():
+            thread.join(max(start + int(interval) - time.time(), 0))
+
+        results = []
+        for hostname, (thread, done) in running.items():
+            if not thread.isAlive():
+                results.extend(done)
+                del running[hostname]
+        submit_results(results)
+        time.sleep(max(start + int(interval) - time.time(), 0))
+
+
 # Main
 def main(argv):
     # Parse command line arguments.
     try:
-        opts, args = getopt.getopt(argv, "H:DTPEhVf:", ["hostname", "help", "version"])
+        opts, args = getopt.getopt(argv, "H:ADTPEShVf:", ["hostname", "help", "version", "daemon", "trace=",
+                                                          "refresh-extends="])
     except getopt.GetoptError:
-        raise CritError("Invalid arguments, usage: -H <hostname>, [-D(space usage)], "
-                        "[-T(triggers)], [-P(perfdata)], [-E(extends)], [-f(config file)], "
+        raise CritError("Invalid arguments, usage: -H <hostname>[,<hostname>], [-A(all hostnames)], "
+                        "[-D(space usage)], [-T(triggers)], [-P(perfdata)], [-E(extends)], "
+                        "[-S(self-monitoring)], [-f(config file)], [--daemon], [--trace=<file>], "
                         "[-h(help)], [-V(version)]")
 
     configfile = ""
+    hostnames = []
+    allhosts = False
+    daemon = False
+    checks = []
+    options = {}
     for opt, arg in opts:
         if opt in ("-H", "--hostname"):
-            nexenta = arg
+            hostnames.extend([hostname for hostname in arg.split(',') if hostname])
+        elif opt == "-A":
+            allhosts = True
         elif opt == "-f":
             configfile = arg
+        elif opt == "--daemon":
+            daemon = True
+        elif opt == "-S":
+            options['stats'] = True
+        elif opt == "--trace":
+            options['trace'] = arg
+        elif opt == "--refresh-extends":
+            options['refresh_extends'] = arg.split(',')
+        elif opt in ("-D", "-T", "-P", "-E"):
+            checks.append(opt)
         elif opt in ("-h", "--help"):
             print_usage()
         elif opt in ("-V", "--version"):
             print_version()
 
-    try:
-        nexenta = { 'hostname': nexenta, 'ip': socket.getaddrinfo(nexenta,None)[0][4][0] }
-    except NameError:
-        raise CritError("Invalid arguments, no hostname specified!")
-    except socket.gaierror:
-        raise CritError("No IP address found for %s!" % nexenta)
-        
-    # If only -H is passed execute default checks.
-    if len(opts) == 1:
-        opts.extend([("-D", ""), ("-T", "")])
+    # Profile the whole run, the profile is written next to the trace. Checks run in threads,
+    # every thread started during the run gets a profile of its own on its first profile
+    # event, and all profiles are merged into one file.
+    if 'trace' in options:
+        import cProfile
+        profiles = [cProfile.Profile()]
+
+        def profile_thread(frame, event, arg):
+            profile = cProfile.Profile()
+            profiles.append(profile)
+            profile.enable()
+
+        threading.setprofile(profile_thread)
+        profiles[0].enable()
+        try:
+            return run_main(configfile, hostnames, allhosts, daemon, checks, options)
+        finally:
+            profiles[0].disable()
+            threading.setprofile(None)
+            write_profile(profiles, options['trace'] + '.prof')
+    return run_main(configfile, hostnames, allhosts, daemon, checks, options)
+
+
+# Merge the profiles of all threads of a run into one file, threads that recorded nothing
+# are skipped.
+def write_profile(profiles, path):
+    import pstats
+    stats = None
+    for profile in profiles:
+        try:
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        except TypeError:
+            continue
+    if stats is not None:
+        stats.dump_stats(path)
+
 
+def run_main(configfile, hostnames, allhosts, daemon, checks, options):
     # Open the configfile for use and start the checks.
     cfg = ReadConfig()
     cfg.open_config(configfile)
 
-    output = []
-    perfdata = []
-    for opt, arg in opts:
-        if opt == "-D":
-            # Check spage usage.
-            result = check_spaceusage(nexenta)
-            if result:
-                output.extend(result)
-        elif opt == "-T":
-            # Check fault triggers.
-            result = check_triggers(nexenta)
-            if result:
-                output.extend(result)
-        elif opt == "-E":
-            # Run SNMP extend scripts and collect output/performance data.
-            out, perf = collect_extends(nexenta)
-            if out:
-                output.extend(out)
-            if perf:
-                perfdata.extend(perf)
-        elif opt == "-P":
-            # Collect performance data.
-            out, perf = collect_perfdata(nexenta)
-            if out:
-                output.extend(out)
-            if perf:
-                perfdata.extend(perf)
+    if daemon:
+        run_daemon()
 
-    if NagiosStates.RC == NagiosStates.OK:
-        output.append("Nexenta check OK")
+    if allhosts:
+        hostnames = cfg.hostnames()
+    if not hostnames:
+        raise CritError("Invalid arguments, no hostname specified!")
 
-    # Append performance data if collected and print output.
-    if perfdata:
-        return "%s|%s" % ("<br>".join(output), " ".join(perfdata))
-    else:
-        return ("<br>".join(output))
+    # Started by ExtendCache in the background, to read stale extends of one Nexenta.
+    if 'refresh_extends' in options:
+        return refresh_extends(resolve(hostnames[0]), options['refresh_extends'])
+
+    # If no checks are passed execute default checks.
+    if not checks:
+        checks = ["-D", "-T"]
+
+    if len(hostnames) > 1:
+        return run_batch(hostnames, checks, options)
+    return run_checks(resolve(hostnames[0]), checks, options)
 
 def print_usage():
     print "usage: check_nexenta.py -H <arg> [options]"
     print "Options and arguments (defaults to [-D, -T] if only -H is given):"
     print "-H arg : Nexenta to check. Can be hostname or IP adress. Must be configured in"
-    print "         the config file. Short for --hostname."
+    print "         the config file. Short for --hostname. Multiple Nexentas can be given"
+    print "         separated by commas, they are checked at the same time and a result"
+    print "         line is printed for each. The worst state is returned."
+    print "-A     : Check all Nexentas configured in the config file, like -H with"
+    print "         multiple Nexentas."
     print "-D     : Check space usage of volumes. Thresholds are configured in the config"
-    print "         file."
+    print "         file. The used space is kept in state_dir if forecast_threshold is"
+    print "         set."
     print "-T     : Check fault triggers."
     print "-P     : Report SNMP performance data. Must be configured in the config file."
-    print "         Reports data for CPU, Disk, Snapshot, Memory and Network."
+    print "         Reports data for CPU, Disk, Snapshot, Memory and Network. Network"
+    print "         traffic is also reported in bit/s since the previous run, the"
+    print "         counters are kept in state_dir."
     print "-E     : Report SNMP extend data. Must be configured in the config file."
     print "       : See help below on snmp_extend for more info."
     print "-f     : Config file to use. Defaults to <scriptname>.cfg if not given."
+    print "         The parsed file is cached in check_nexenta-<uid> in the temp directory"
+    print "         until it changes."
+    print "-S     : Add perfdata on the number and time of API, SNMP and DNS calls made by"
+    print "         this check, e.g. 'nms_calls'=612 'nms_time'=8.4s 'snmp_time'=1.2s."
+    print "--trace=file: Append a line per API and SNMP call with its time, size and"
+    print "         retries to file, and write a cProfile profile of the run to"
+    print "         file.prof, with the profiles of all its threads merged."
+    print "--daemon: Keep running the services configured at [daemon] for all Nexentas,"
+    print "         and submit the results as passive checks. See [daemon] below."
     print "-V     : Show version information. Short for --version."
     print "-h     : Show help information. Short for --help."
     print ""
@@ -630,13 +3102,18 @@ def print_usage():
     print "api_ssl_insecure: Do not validate certificates when connecting via SSL."
     print "api_port        : Port used for API connection to the Nexenta. Defaults to"
     print "                  standard NMV port (2000) if not set."
+    print "api_pool_size   : Max number of idle keep-alive connections kept open to the"
+    print "                  API during a run. Defaults to 4 if not set."
     print "snmp_user       : SNMP username with ro rights on the Nexenta. Only needed"
-    print "                  for SNMP v3."
+    print "                  for SNMP v3. The SNMP engine of the Nexenta is kept in"
+    print "                  state_dir, so most runs skip the engine discovery."
     print "snmp_pass       : Password for the SNMP user. Only needed for SNMP v3."
     print "snmp_community  : SNMP ro community. Only needed for SNMP v2. Will not be"
     print "                  used if snmp_user and snmp_pass are configured."
     print "snmp_port       : Port used for SNMP connection to the Nexenta. Defaults to"
     print "                  standard SNMP port (161) if not set."
+    print "snmp_bulk_size  : Number of table rows requested per SNMP GETBULK request."
+    print "                  Defaults to 50 if not set."
     print "snmp_extend     : If set to ON, query SNMP extend for data. SNMP extend on a"
     print "                  Nexenta can be multiple scripts. Each line of output from a"
     print "                  extend script must start with PERFDATA: followed by any"
@@ -645,27 +3122,114 @@ def print_usage():
     print "                  Two examples of output extend scripts could generate:"
     print "                  PERFDATA:'ARC hit'=75% 'ARC miss'=17%"
     print "                  OUTPUT:WARNING: ARC hit ratio below 80%!"
+    print "extend_ttl      : Keep the output of SNMP extends in state_dir, as snmpd runs"
+    print "                  the script of every extend read. Can be multiple lines"
+    print "                  formatted as <extend>;<seconds>[;<max age>], e.g."
+    print "                  arcstats;300, or DEFAULT;<seconds> for all other extends."
+    print "                  Output older than its TTL is reported while a process"
+    print "                  started in the background reads the extend again. Output"
+    print "                  older than max age, 5 times the TTL by default, is read"
+    print "                  during the run. Cached output is reported with its age,"
+    print "                  and '<extend> age' is added to the perfdata. A failed"
+    print "                  refresh is reported as UNKNOWN by the next run. Extends"
+    print "                  without a TTL are read on every run."
     print "skip_trigger    : If set to ON, do not check fault triggers. Usefull to "
     print "                  prevent double fault reporting when checking a virtual node"
     print "                  of a Nexenta HA cluster."
+    print "fault_digest_ttl: Keep the faults of every trigger in state_dir, with the state"
+    print "                  and fault count in the status of the trigger. Triggers with"
+    print "                  0 faults are listed with one call, of the others only the"
+    print "                  status is read and faults are fetched once it changed, or"
+    print "                  once they are older than this many seconds. Faults kept are"
+    print "                  only classified with known_errors again if the config file"
+    print "                  changed. Disabled if not set."
     print "skip_folderperf : If set to ON, do not return performance data for folders."
     print "                  Usefull to prevent double performance reporting when checking"
     print "                  a virtual node of a Nexenta HA cluster."
+    print "folder_include  : Only check folders matching these regular expressions, one"
+    print "                  per line, e.g. ^pool0/[^/]+$ for the top-level folders of"
+    print "                  pool0. Passed to NMS, so other folders are never listed."
+    print "                  Used by -D and -P. All folders are checked if not set."
+    print "folder_exclude  : Skip folders matching these regular expressions, one per"
+    print "                  line. Applied after folder_include, also to syspool."
     print "space_threshold : Thresholds for the folder space usage check. Can be multiple"
     print "                  lines formatted as <folder>;<vol-warning>;<vol-critical>;"
     print "                  <snap-warning>;<snap-critical>."
-    print "                  <folder> can be a specific volume or DEFAULT."
+    print "                  <folder> can be a specific volume, a pattern like"
+    print "                  pool0/home/* or DEFAULT. A specific volume is used before"
+    print "                  a pattern, patterns are matched in the configured order."
     print "                  Volume thresholds can be a percentage of space used(%),"
     print "                  amount of free space([M,G,T]) or IGNORE."
     print "                  Snapshot thresholds can be a percentage of space used(%),"
     print "                  amount of space used([M,G,T]) or IGNORE."
     print "                  DEFAULT thresholds are applied to all folders not specified."
+    print "forecast_threshold: Thresholds for the number of days until a folder is full,"
+    print "                  forecast by -D from the trend of the used space over the"
+    print "                  last forecast_history days. Can be multiple lines formatted as"
+    print "                  <folder>;<days-warning>;<days-critical>, <folder> like for"
+    print "                  space_threshold. A day count can be IGNORE. Folders need 12"
+    print "                  hourly samples before they are forecast."
+    print "forecast_history: Days of used space kept per folder for forecast_threshold,"
+    print "                  one sample per hour. Defaults to 14 if not set."
+    print "traffic_threshold: Thresholds for the network traffic of interfaces reported by"
+    print "                  -P. Can be multiple lines formatted as <interface>;"
+    print "                  <in-warning>;<in-critical>;<out-warning>;<out-critical>."
+    print "                  <interface> can be an interface name, a pattern like ixgbe*"
+    print "                  or DEFAULT, like <folder> of space_threshold. Thresholds are"
+    print "                  in bit/s with an optional K, M, G or T, or IGNORE. If only"
+    print "                  in thresholds are given, they also apply to out."
     print "nms_retry       : Sets the max number of retries when NMS is unresponsive."
-    print "                  Defaults to 2 if not set."
+    print "                  Defaults to 2 if not set. The wait between retries doubles"
+    print "                  each time, and no retry is made after check_timeout."
+    print "nms_breaker     : Number of consecutive runs in which NMS failed, after which"
+    print "                  UNKNOWN is returned at once without calling the API. The"
+    print "                  state is kept in state_dir and added to the output and"
+    print "                  perfdata. Disabled if not set."
+    print "nms_breaker_probe: Seconds after which one run tries NMS again while the"
+    print "                  breaker is open. Defaults to 300 if not set."
+    print "api_concurrency : Max number of API calls made at the same time, e.g. when"
+    print "                  fetching folder properties or trigger faults. Shared by all"
+    print "                  checks of a run. Defaults to 4 if not set."
+    print "check_timeout   : Seconds after which all checks are stopped and UNKNOWN is"
+    print "                  returned with the results collected so far. Defaults to 55"
+    print "                  if not set."
+    print "state_dir       : Directory for files kept between runs, like the API cache."
+    print "                  Defaults to check_nexenta-<uid> in the temp directory if not"
+    print "                  set. Can be set for all Nexentas in a [DEFAULT] section."
+    print "                  Only used if owned by the user running the check and not"
+    print "                  writable by others, it is created with mode 0700."
+    print "api_cache_ttl   : Cache API results on disk, so checks run shortly after each"
+    print "                  other share them. Can be multiple lines formatted as"
+    print "                  <object>.<method>;<seconds>, e.g. folder.get_names;300."
+    print "                  Only the configured methods are cached."
+    print "api_cache_size  : Max size of the API cache([K,M,G]), least recently used"
+    print "                  results are removed first. Defaults to 10M if not set."
+    print "dns_cache_ttl   : Keep the address of the Nexenta in state_dir for this many"
+    print "                  seconds, so most runs skip the DNS lookup. Disabled if not set."
+    print "identity_ttl    : Identify the Nexenta by the hostid of its NMS, kept in"
+    print "                  state_dir for this many seconds. Checks of Nexentas with the"
+    print "                  same hostid, like a VIP and the node that has it, share the"
+    print "                  folder and trigger data they fetch while they run at the same"
+    print "                  time, e.g. with -A, and share api_cache_ttl results. Keep it"
+    print "                  short for a VIP, it moves on failover. Disabled if not set."
+    print "[daemon]        : Settings for --daemon."
+    print "  interval      : Seconds between runs. Defaults to 300 if not set."
+    print "  hosts         : Nexentas to check, separated by spaces. Defaults to all"
+    print "                  configured Nexentas if not set."
+    print "  services      : Services to submit. Can be multiple lines formatted as"
+    print "                  <service description>;<checks>, where <checks> are the"
+    print "                  letters of the options to run, e.g. Nexenta Perfdata;PE."
+    print "                  Defaults to Nexenta;DT if not set."
+    print "  command_file  : Nagios command file to write passive check results to."
+    print "  send_nsca     : Path to send_nsca, to submit passive check results via NSCA."
+    print "  nsca_host     : NSCA server to submit results to."
+    print "  nsca_config   : Config file for send_nsca."
     print "[known_errors]  : Convert severity and/or description of known error messages."
     print "                  Can consist of multiple error messages formatted as"
     print "                  <error message> = <severity>;<description>."
     print "                  <error message> can be a part of a error message or DEFAULT."
+    print "                  If an error message matches multiple lines, the first line"
+    print "                  in the config file is used."
     print "                  <severity> can be DEFAULT,WARNING,CRITICAL,UNKNOWN or IGNORE"
     print "                  DEFAULT severity does not change the original severity level."
     print "                  If IGNORE is set as severity the entire message is ignored."
@@ -681,5 +3245,12 @@ def print_version():
     sys.exit()
 
 if __name__ == '__main__':
-    print main(sys.argv[1:])
-    sys.exit(NagiosStates.RC)
+    try:
+        state, output = main(sys.argv[1:])
+    except (CritError, UnknownError), error:
+        state, output = error.state, "%s: %s" % (error.label, error)
+    print output
+
+    # Exit without waiting for API calls still running after the deadline.
+    sys.stdout.flush()
+    os._exit(state)